@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+import cv2
+
+from yolov7.utils.plots import plot_one_box
+
+
+class AsyncVideoWriter:
+    """
+    Draws the boxes and encodes the result videos on a background thread. Frames are handed
+    over by reference together with their boxes through a bounded queue, so `write` blocks
+    (backpressure) instead of buffering frames without limit when encoding falls behind.
+    """
+
+    def __init__(self, maxsize=8, line_thickness=2):
+        self.line_thickness = line_thickness
+        self.queue = Queue(maxsize=maxsize)
+        self.writers = {}  # source index -> (save_path, cv2.VideoWriter)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, index, save_path, fps, size, frame, boxes=()):
+        # boxes: iterable of (xyxy, label, color) to draw on frame before encoding it
+        self._check()
+        self.queue.put((index, save_path, fps, size, frame, boxes))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:  # drain the queue after a failure
+                continue
+            try:
+                self._encode(*item)
+            except Exception as e:
+                self.error = e
+        for _, vid_writer in self.writers.values():
+            vid_writer.release()
+
+    def _encode(self, index, save_path, fps, size, frame, boxes):
+        for xyxy, label, color in boxes:
+            plot_one_box(xyxy, frame, label=label, color=color, line_thickness=self.line_thickness)
+
+        if index not in self.writers or self.writers[index][0] != save_path:  # new video
+            if index in self.writers:
+                self.writers[index][1].release()  # release previous video writer
+            self.writers[index] = (save_path, cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size))
+        self.writers[index][1].write(frame)
+
+
+class AsyncImageWriter:
+    """
+    Encodes and saves images on a pool of worker threads. At most `maxsize` images are
+    pending at any time, `imwrite` blocks when the limit is reached.
+    """
+
+    def __init__(self, workers=4, maxsize=16):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(maxsize)
+        self.futures = []
+
+    def imwrite(self, path, img):
+        self.slots.acquire()
+        future = self.pool.submit(cv2.imwrite, str(path), img)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        for future in self.futures:
+            future.result()  # re-raise errors of the workers
+        self.futures = []
@@ -0,0 +1,91 @@
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+
+class BestFrameStore:
+    """
+    Keeps only the frames that are currently the max-confidence frame of some object ID.
+    Frames are reference counted by the IDs pointing at them and dropped as soon as no ID
+    refers to them. When more than `max_in_memory` frames are alive, the least recently
+    referenced ones are spilled to `cache_dir` as .npy files and loaded back on demand.
+    """
+
+    def __init__(self, max_in_memory=None, cache_dir=None):
+        self.max_in_memory = max_in_memory
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.max_in_memory is not None and self.cache_dir is None:
+            raise ValueError('cache_dir is required when max_in_memory is set')
+
+        self.best = {}  # id -> (frame_idx, conf)
+        self.refs = {}  # frame_idx -> number of IDs whose best frame it is
+        self.frames = OrderedDict()  # frame_idx -> image, least recently referenced first
+        self.spilled = set()  # frame_idx of frames living in cache_dir
+
+    def __len__(self):
+        return len(self.refs)
+
+    def update(self, frame_idx, frame, ids, confs):
+        # Point every ID whose confidence improved at this frame, the frame is copied only if needed
+        for id_obj, conf in zip(ids, confs):
+            prev = self.best.get(id_obj)
+            if prev is not None and conf <= prev[1]:  # keep the first frame with the max conf
+                continue
+            if prev is not None:
+                self._unref(prev[0])
+            self.best[id_obj] = (frame_idx, conf)
+            if frame_idx not in self.refs:
+                self.refs[frame_idx] = 0
+                self.frames[frame_idx] = frame.copy()
+            self.refs[frame_idx] += 1
+            self.frames.move_to_end(frame_idx)
+
+        self._spill()
+
+    def best_frame(self, id_obj):
+        return self.best[id_obj][0]
+
+    def frame(self, frame_idx):
+        # Returns the stored frame, loading it back from the cache if it was spilled
+        if frame_idx in self.spilled:
+            path = self._cache_path(frame_idx)
+            self.frames[frame_idx] = np.load(path)
+            self.spilled.discard(frame_idx)
+            os.remove(path)
+        return self.frames[frame_idx]
+
+    def drop(self, id_obj):
+        # Forget an ID, releasing its frame if no other ID refers to it
+        frame_idx, _ = self.best.pop(id_obj)
+        self._unref(frame_idx)
+
+    def close(self):
+        for frame_idx in list(self.spilled):
+            os.remove(self._cache_path(frame_idx))
+        self.best, self.refs, self.frames, self.spilled = {}, {}, OrderedDict(), set()
+        if self.cache_dir is not None and self.cache_dir.is_dir() and not any(self.cache_dir.iterdir()):
+            self.cache_dir.rmdir()
+
+    def _unref(self, frame_idx):
+        self.refs[frame_idx] -= 1
+        if self.refs[frame_idx] == 0:
+            del self.refs[frame_idx]
+            if frame_idx in self.spilled:
+                self.spilled.discard(frame_idx)
+                os.remove(self._cache_path(frame_idx))
+            else:
+                del self.frames[frame_idx]
+
+    def _spill(self):
+        if self.max_in_memory is None:
+            return
+        while len(self.frames) > self.max_in_memory:
+            frame_idx, img = self.frames.popitem(last=False)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            np.save(self._cache_path(frame_idx), img)
+            self.spilled.add(frame_idx)
+
+    def _cache_path(self, frame_idx):
+        return self.cache_dir / f'{frame_idx}.npy'
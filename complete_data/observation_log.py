@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+
+class ObservationLog:
+    """
+    Columnar log of the tracked objects, one row per (frame, ID) observation.
+    Rows are appended a frame at a time to growable numpy arrays and the per-ID
+    table is computed at the end with a single group-by.
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.frame = np.empty(capacity, dtype=np.int64)
+        self.id = np.empty(capacity, dtype=np.int64)
+        self.cls = np.empty(capacity, dtype=np.int64)
+        self.conf = np.empty(capacity, dtype=np.float64)
+        self.bbox = np.empty((capacity, 4), dtype=np.float64)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, frame_idx, ids, classes, confs, bboxes):
+        # Add the observations of one frame
+        n = len(ids)
+        if n == 0:
+            return
+        if self.size + n > len(self.frame):  # se duplica la capacidad
+            capacity = max(2 * len(self.frame), self.size + n)
+            for name in ('frame', 'id', 'cls', 'conf', 'bbox'):
+                old = getattr(self, name)
+                new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, name, new)
+
+        rows = slice(self.size, self.size + n)
+        self.frame[rows] = frame_idx
+        self.id[rows] = ids
+        self.cls[rows] = classes
+        self.conf[rows] = confs
+        self.bbox[rows] = np.asarray(bboxes, dtype=np.float64).reshape(n, 4)
+        self.size += n
+
+    def to_frame(self):
+        n = self.size
+        df = pd.DataFrame({'frame': self.frame[:n], 'id': self.id[:n], 'cls': self.cls[:n], 'conf': self.conf[:n]})
+        df[['x1', 'y1', 'x2', 'y2']] = self.bbox[:n]
+        return df
+
+    def summary(self):
+        # One row per ID, in order of first appearance:
+        # class of the first observation, max and min confidence, frame and bbox of the first max
+        # confidence and last frame the ID was seen
+        df = self.to_frame()
+        groups = df.groupby('id', sort=False)
+        best = df.loc[groups['conf'].idxmax().to_numpy()].reset_index(drop=True)
+        return pd.DataFrame({
+            'id': best['id'].to_numpy(),
+            'cls': groups['cls'].first().to_numpy(),
+            'max_conf': best['conf'].to_numpy(),
+            'min_conf': groups['conf'].min().to_numpy(),
+            'best_frame': best['frame'].to_numpy(),
+            'last_frame': groups['frame'].last().to_numpy(),
+            'x1': best['x1'].to_numpy(), 'y1': best['y1'].to_numpy(),
+            'x2': best['x2'].to_numpy(), 'y2': best['y2'].to_numpy(),
+        })
@@ -0,0 +1,63 @@
+import os
+import time
+
+import numpy as np
+
+MOT_FMT = '%g ' * 10  # frame, id, bbox_left, bbox_top, bbox_w, bbox_h, -1, -1, -1, source
+
+
+class MOTWriter:
+    """
+    Buffered writer for MOT formatted results. Keeps one open handle per output path and
+    writes the buffered rows of all frames with a single formatted numpy write once
+    `flush_rows` rows are pending or `flush_secs` seconds have passed since the last flush.
+    With `binary`, the flushed rows are appended as raw float64 to a .bin file instead (10 values
+    per row, readable after a crash with np.fromfile), which is converted to the columns of a .npz
+    file on close.
+    """
+
+    def __init__(self, flush_rows=1000, flush_secs=1.0, binary=False):
+        self.flush_rows = flush_rows
+        self.flush_secs = flush_secs
+        self.binary = binary
+        self.files = {}  # path -> open text or .bin file
+        self.buffers = {}  # path -> list of (n, 10) arrays
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, path, rows):
+        # Add the (n, 10) MOT rows of a frame
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, 10)
+        if not len(rows):
+            return
+        self.buffers.setdefault(path, []).append(rows)
+        self.pending += len(rows)
+        if self.pending >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        for path, chunks in self.buffers.items():
+            if path not in self.files:
+                self.files[path] = open(path + '.bin', 'wb') if self.binary else open(path + '.txt', 'a')
+            if self.binary:
+                np.concatenate(chunks).tofile(self.files[path])
+            else:
+                np.savetxt(self.files[path], np.concatenate(chunks), fmt=MOT_FMT)
+            self.files[path].flush()
+        self.buffers = {}
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        if self.binary:  # columns of the .npz, read back one at a time from the memory mapped rows
+            for path in self.files:
+                rows = np.memmap(path + '.bin', dtype=np.float64, mode='r').reshape(-1, 10)
+                np.savez(path + '.npz', frame=rows[:, 0].astype(np.int64), id=rows[:, 1].astype(np.int64),
+                         bbox_left=rows[:, 2], bbox_top=rows[:, 3], bbox_w=rows[:, 4], bbox_h=rows[:, 5],
+                         source=rows[:, 9].astype(np.int64))
+                del rows  # release the mapping before removing the file
+                os.remove(path + '.bin')
+        self.files = {}
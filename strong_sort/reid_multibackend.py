@@ -3,6 +3,7 @@ import torch
 from pathlib import Path
 import numpy as np
 import torchvision.transforms as transforms
+from torchvision.ops import roi_align
 import cv2
 import pandas as pd
 import gdown
@@ -26,7 +27,7 @@ def check_suffix(file='yolov5s.pt', suffix=('.pt',), msg=''):
 
 class ReIDDetectMultiBackend(nn.Module):
     # ReID models MultiBackend class for python inference on various backends
-    def __init__(self, weights='osnet_x0_25_msmt17.pt', device=torch.device('cpu'), fp16=False):
+    def __init__(self, weights='osnet_x0_25_msmt17.pt', device=torch.device('cpu'), fp16=False, max_batch=32):
         super().__init__()
         w = str(weights[0] if isinstance(weights, list) else weights)
         self.pt, self.jit, self.onnx, self.xml, self.engine, self.coreml, \
@@ -59,6 +60,8 @@ class ReIDDetectMultiBackend(nn.Module):
             import onnxruntime
             providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if cuda else ['CPUExecutionProvider']
             self.session = onnxruntime.InferenceSession(w, providers=providers)
+            # models exported with a fixed batch dimension can only take one crop per run
+            self.onnx_dynamic = not isinstance(self.session.get_inputs()[0].shape[0], int)
         
         elif self.tflite:
             try:  # https://coral.ai/docs/edgetpu/tflite-python/#update-existing-tf-lite-code-for-the-edge-tpu
@@ -66,7 +69,7 @@ class ReIDDetectMultiBackend(nn.Module):
             except ImportError:
                 import tensorflow as tf
                 Interpreter, load_delegate = tf.lite.Interpreter, tf.lite.experimental.load_delegate,
-            self.interpreter = tf.lite.Interpreter(model_path=weights)
+            self.interpreter = Interpreter(model_path=weights)
             self.interpreter.allocate_tensors()
             # Get input and output tensors.
             self.input_details = self.interpreter.get_input_details()
@@ -91,9 +94,13 @@ class ReIDDetectMultiBackend(nn.Module):
             transforms.ToTensor(),
             transforms.Normalize(pixel_mean, pixel_std),
         ])
+        # same normalization as self.norm, applied to a whole (N, 3, H, W) batch at once
+        self.pixel_mean = torch.tensor(pixel_mean, device=device).view(1, 3, 1, 1)
+        self.pixel_std = torch.tensor(pixel_std, device=device).view(1, 3, 1, 1)
         self.size = (256, 128)
         self.fp16 = fp16
         self.device = device
+        self.max_batch = max_batch  # max crops per forward pass, bounds peak memory on crowded frames
         
     def export_formats(self):
         # YOLOv5 export formats
@@ -137,45 +144,66 @@ class ReIDDetectMultiBackend(nn.Module):
         def _resize(im, size):
             return cv2.resize(im.astype(np.float32), size)
 
-        im = torch.cat([self.norm(_resize(im, self.size)).unsqueeze(0) for im in im_crops], dim=0).float()
-        im = im.float().to(device=self.device)
-        return im
-    
-    def forward(self, im_batch):
-        im_batch = self.preprocess(im_batch)
+        im = np.stack([_resize(im, self.size) for im in im_crops])  # N,H,W,C
+        im = torch.from_numpy(im).to(device=self.device).permute(0, 3, 1, 2)
+        return (im - self.pixel_mean) / self.pixel_std
+
+    def preprocess_boxes(self, im0, boxes):
+        # Crop and resize every box of the frame with a single roi_align call on the device.
+        # Sampling once per output pixel with aligned=True matches the bilinear cv2.resize of the crop,
+        # self.size is in cv2 (w, h) order
+        im = torch.from_numpy(np.ascontiguousarray(im0)).to(device=self.device)
+        im = im.permute(2, 0, 1).unsqueeze(0).float()  # 1,C,H,W
+        boxes = torch.as_tensor(boxes, dtype=torch.float32, device=self.device).reshape(-1, 4)
+        rois = torch.cat([torch.zeros_like(boxes[:, :1]), boxes], dim=1)  # batch index, x1, y1, x2, y2
+        im = roi_align(im, rois, output_size=self.size[::-1], spatial_scale=1.0, sampling_ratio=1, aligned=True)
+        return (im - self.pixel_mean) / self.pixel_std
+
+    def forward(self, im_batch, boxes=None):
+        # im_batch is a list of crops, or the whole frame when the xyxy boxes to crop are given
+        im_batch = self.preprocess(im_batch) if boxes is None else self.preprocess_boxes(im_batch, boxes)
         b, ch, h, w = im_batch.shape  # batch, channel, height, width
-        features = []
-        for i in range(0, im_batch.shape[0]):
-            im = im_batch[i, :, :, :].unsqueeze(0)
-            if self.fp16 and im.dtype != torch.float16:
-                im = im.half()  # to FP16
-            if self.pt:  # PyTorch
-                y = self.extractor.model(im)[0]
-            elif self.jit:  # TorchScript
-                y = self.model(im)[0]
-            elif self.onnx:  # ONNX Runtime
-                im = im.permute(0, 1, 3, 2).cpu().numpy()  # torch to numpy  # torch to numpy
-                y = self.session.run([self.session.get_outputs()[0].name], {self.session.get_inputs()[0].name: im})[0]
-            elif self.xml:  # OpenVINO
-                im = im.cpu().numpy()  # FP32
-                y = self.executable_network([im])[self.output_layer]
-            else:  # TensorFlow (SavedModel, GraphDef, Lite, Edge TPU)
-                im = im.permute(0, 3, 2, 1).cpu().numpy()  # torch BCHW to numpy BHWC shape(1,320,192,3)
+        if self.fp16 and im_batch.dtype != torch.float16:
+            im_batch = im_batch.half()  # to FP16
+        # run the crops in chunks of at most max_batch, one forward pass per chunk
+        features = [self.inference(im) for im in torch.split(im_batch, self.max_batch or b)]
+        return torch.cat(features, dim=0)  # (N, D)
+
+    def inference(self, im):
+        if self.pt:  # PyTorch
+            y = self.extractor.model(im)
+        elif self.jit:  # TorchScript
+            y = self.model(im)
+        elif self.onnx:  # ONNX Runtime
+            im = im.permute(0, 1, 3, 2).cpu().numpy()  # torch to numpy
+            name_in, name_out = self.session.get_inputs()[0].name, self.session.get_outputs()[0].name
+            if self.onnx_dynamic:
+                y = self.session.run([name_out], {name_in: im})[0]
+            else:
+                y = np.concatenate([self.session.run([name_out], {name_in: x[None]})[0] for x in im], axis=0)
+        elif self.xml:  # OpenVINO
+            im = im.cpu().numpy()  # FP32
+            y = self.executable_network([im])[self.output_layer]
+        else:  # TensorFlow (SavedModel, GraphDef, Lite, Edge TPU)
+            im = im.permute(0, 3, 2, 1).cpu().numpy()  # torch BCHW to numpy BHWC shape(1,320,192,3)
+            input, output = self.input_details[0], self.output_details[0]
+            if input['shape'][0] != im.shape[0]:  # resize the input tensor to the current batch
+                self.interpreter.resize_tensor_input(input['index'], im.shape)
+                self.interpreter.allocate_tensors()
+                self.input_details = self.interpreter.get_input_details()
+                self.output_details = self.interpreter.get_output_details()
                 input, output = self.input_details[0], self.output_details[0]
-                int8 = input['dtype'] == np.uint8  # is TFLite quantized uint8 model
-                if int8:
-                    scale, zero_point = input['quantization']
-                    im = (im / scale + zero_point).astype(np.uint8)  # de-scale
-                self.interpreter.set_tensor(input['index'], im)
-                self.interpreter.invoke()
-                y = torch.tensor(self.interpreter.get_tensor(output['index']))
-                if int8:
-                    scale, zero_point = output['quantization']
-                    y = (y.astype(np.float32) - zero_point) * scale  # re-scale
-            
-            if isinstance(y, np.ndarray):
-                y = torch.tensor(y, device=self.device)
-            features.append(y.squeeze())
+            int8 = input['dtype'] == np.uint8  # is TFLite quantized uint8 model
+            if int8:
+                scale, zero_point = input['quantization']
+                im = (im / scale + zero_point).astype(np.uint8)  # de-scale
+            self.interpreter.set_tensor(input['index'], im)
+            self.interpreter.invoke()
+            y = self.interpreter.get_tensor(output['index'])
+            if int8:
+                scale, zero_point = output['quantization']
+                y = (y.astype(np.float32) - zero_point) * scale  # re-scale
 
-        
-        return features
\ No newline at end of file
+        if isinstance(y, np.ndarray):
+            y = torch.tensor(y, device=self.device)
+        return y.reshape(im.shape[0], -1)
@@ -0,0 +1,157 @@
+# vim: expandtab:ts=4:sw=4
+import cv2
+import numpy as np
+
+
+class CameraMotionEstimator(object):
+    """
+    Frame-level camera motion compensation based on ECC image alignment.
+
+    The warp between two consecutive frames is estimated once per frame and
+    applied to the Kalman states of all tracks in one vectorized step. The
+    grayscale, downscaled version of the last frame is cached so that every
+    frame is converted only once.
+
+    Parameters
+    ----------
+    warp_mode : int
+        OpenCV motion model, one of cv2.MOTION_TRANSLATION, cv2.MOTION_EUCLIDEAN,
+        cv2.MOTION_AFFINE or cv2.MOTION_HOMOGRAPHY.
+    eps : float
+        The threshold of the increment in the correlation coefficient between
+        two iterations.
+    max_iter : int
+        The number of iterations.
+    scale : float or [int, int]
+        Either a scale ratio or a target size [W, H] applied to the frames
+        before alignment to speed it up.
+    """
+
+    def __init__(self, warp_mode=cv2.MOTION_EUCLIDEAN, eps=1e-5, max_iter=100, scale=0.1):
+        self.warp_mode = warp_mode
+        self.criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, max_iter, eps)
+        self.scale = scale
+
+        self._last_img = None  # last frame passed as current image
+        self._last_small = None  # its grayscale, downscaled version
+        self._last_ratio = None
+
+    def _prepare(self, img):
+        """Convert a frame to grayscale and downscale it.
+
+        Returns
+        -------
+        (ndarray, Optional[List[float]])
+            The small grayscale image and the [x, y] scale ratio used, or None
+            if the image was not resized.
+        """
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+        scale = self.scale
+        if scale is None:
+            return img, None
+        if isinstance(scale, float) or isinstance(scale, int):
+            if scale == 1:
+                return img, None
+            small = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+            return small, [scale, scale]
+        if scale[0] != img.shape[1] and scale[1] != img.shape[0]:
+            small = cv2.resize(img, (scale[0], scale[1]), interpolation=cv2.INTER_LINEAR)
+            return small, [scale[0] / img.shape[1], scale[1] / img.shape[0]]
+        return img, None
+
+    def estimate(self, previous_img, current_img):
+        """Compute the warp matrix from the previous to the current frame.
+
+        Parameters
+        ----------
+        previous_img : Optional[ndarray]
+            The previous frame (BGR or gray). If it is the frame passed as
+            `current_img` on the last call, its cached gray version is reused.
+        current_img : Optional[ndarray]
+            The current frame, in the same format as `previous_img`.
+
+        Returns
+        -------
+        Optional[ndarray]
+            The 3x3 warp matrix, or None if it could not be estimated (first
+            frame, different frame sizes or no convergence).
+        """
+        if current_img is None:
+            return None
+
+        if previous_img is not None and previous_img is self._last_img:
+            prev_small, prev_ratio = self._last_small, self._last_ratio
+        elif previous_img is not None:
+            prev_small, prev_ratio = self._prepare(previous_img)
+        curr_small, curr_ratio = self._prepare(current_img)
+        self._last_img, self._last_small, self._last_ratio = current_img, curr_small, curr_ratio
+
+        # skip if the previous frame is not initialized (1st inference) or has another size
+        if previous_img is None or previous_img.shape != current_img.shape:
+            return None
+
+        if self.warp_mode == cv2.MOTION_HOMOGRAPHY:
+            warp_matrix = np.eye(3, 3, dtype=np.float32)
+        else:
+            warp_matrix = np.eye(2, 3, dtype=np.float32)
+
+        try:
+            (cc, warp_matrix) = cv2.findTransformECC(
+                prev_small, curr_small, warp_matrix, self.warp_mode, self.criteria, None, 1)
+        except cv2.error as e:
+            return None
+
+        if curr_ratio is not None:
+            warp_matrix[0, 2] = warp_matrix[0, 2] / curr_ratio[0]
+            warp_matrix[1, 2] = warp_matrix[1, 2] / curr_ratio[1]
+
+        matrix = np.eye(3)
+        matrix[:2] = warp_matrix[:2]
+        # discard degenerate solutions
+        if np.linalg.norm(np.eye(3) - matrix) >= 100:
+            return None
+        return matrix
+
+    @staticmethod
+    def apply(matrix, mean, covariance):
+        """Warp the Kalman states of N tracks with the camera motion.
+
+        The top-left and bottom-right box corners are warped to obtain the new
+        box, velocities and covariances are rotated by the linear part of the
+        warp.
+
+        Parameters
+        ----------
+        matrix : ndarray
+            The 3x3 warp matrix returned by `estimate`.
+        mean : ndarray
+            The Nx8 dimensional mean vectors (x, y, a, h, vx, vy, va, vh).
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices.
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the warped mean vectors and covariance matrices.
+        """
+        mean = mean.copy()
+        w = mean[:, 2] * mean[:, 3]
+        tl = mean[:, :2] - np.stack([w, mean[:, 3]], axis=1) / 2
+        br = tl + np.stack([w, mean[:, 3]], axis=1)
+
+        rot, trans = matrix[:2, :2], matrix[:2, 2]
+        tl = tl @ rot.T + trans
+        br = br @ rot.T + trans
+        wh = br - tl
+        mean[:, :2] = tl + wh / 2
+        mean[:, 2] = wh[:, 0] / wh[:, 1]
+        mean[:, 3] = wh[:, 1]
+        mean[:, 4:6] = mean[:, 4:6] @ rot.T
+
+        transform = np.eye(8)
+        transform[:2, :2] = rot
+        transform[4:6, 4:6] = rot
+        covariance = transform @ covariance @ transform.T
+        return mean, covariance
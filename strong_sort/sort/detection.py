@@ -14,6 +14,9 @@ class Detection(object):
         Detector confidence score.
     feature : array_like
         A feature vector that describes the object contained in this image.
+    cached : bool
+        True if `feature` is the cached feature of a track instead of one
+        extracted from this image.
 
     Attributes
     ----------
@@ -23,13 +26,16 @@ class Detection(object):
         Detector confidence score.
     feature : ndarray | NoneType
         A feature vector that describes the object contained in this image.
+    cached : bool
+        True if `feature` was reused from a track.
 
     """
 
-    def __init__(self, tlwh, confidence, feature):
+    def __init__(self, tlwh, confidence, feature, cached=False):
         self.tlwh = np.asarray(tlwh, dtype=np.float)
         self.confidence = float(confidence)
         self.feature = np.asarray(feature.cpu(), dtype=np.float32)
+        self.cached = cached
 
     def to_tlbr(self):
         """Convert bounding box to format `(min x, min y, max x, max y)`, i.e.,
@@ -39,14 +39,47 @@ def iou(bbox, candidates):
     return area_intersection / (area_bbox + area_candidates - area_intersection)
 
 
+def iou_matrix(bboxes, candidates):
+    """Computer pair-wise intersection over union.
+
+    Parameters
+    ----------
+    bboxes : ndarray
+        An Nx4 matrix of bounding boxes in format `(top left x, top left y,
+        width, height)`.
+    candidates : ndarray
+        An Mx4 matrix of candidate bounding boxes in the same format.
+
+    Returns
+    -------
+    ndarray
+        Returns an NxM matrix where element (i, j) is the intersection over
+        union in [0, 1] between `bboxes[i]` and `candidates[j]`.
+
+    """
+    bboxes_tl, bboxes_br = bboxes[:, None, :2], bboxes[:, None, :2] + bboxes[:, None, 2:]
+    candidates_tl = candidates[None, :, :2]
+    candidates_br = candidates[None, :, :2] + candidates[None, :, 2:]
+
+    tl = np.maximum(bboxes_tl, candidates_tl)
+    br = np.minimum(bboxes_br, candidates_br)
+    wh = np.maximum(0., br - tl)
+
+    area_intersection = wh.prod(axis=2)
+    area_bboxes = bboxes[:, 2:].prod(axis=1)
+    area_candidates = candidates[:, 2:].prod(axis=1)
+    return area_intersection / (
+        area_bboxes[:, None] + area_candidates[None, :] - area_intersection)
+
+
 def iou_cost(tracks, detections, track_indices=None,
              detection_indices=None):
     """An intersection over union distance metric.
 
     Parameters
     ----------
-    tracks : List[deep_sort.track.Track]
-        A list of tracks.
+    tracks : deep_sort.track.TrackStore
+        The tracks.
     detections : List[deep_sort.detection.Detection]
         A list of detections.
     track_indices : Optional[List[int]]
@@ -69,14 +102,12 @@ def iou_cost(tracks, detections, track_indices=None,
     if detection_indices is None:
         detection_indices = np.arange(len(detections))
 
-    cost_matrix = np.zeros((len(track_indices), len(detection_indices)))
-    for row, track_idx in enumerate(track_indices):
-        if tracks[track_idx].time_since_update > 1:
-            cost_matrix[row, :] = linear_assignment.INFTY_COST
-            continue
+    bboxes = tracks.to_tlwh(track_indices)
+    candidates = np.asarray(
+        [detections[i].tlwh for i in detection_indices]).reshape(-1, 4)
+    cost_matrix = 1. - iou_matrix(bboxes, candidates)
 
-        bbox = tracks[track_idx].to_tlwh()
-        candidates = np.asarray(
-            [detections[i].tlwh for i in detection_indices])
-        cost_matrix[row, :] = 1. - iou(bbox, candidates)
+    # Tracks that were not updated in the previous frame are not matched by IoU.
+    stale = tracks.time_since_update[np.asarray(track_indices, dtype=np.int64)] > 1
+    cost_matrix[stale, :] = linear_assignment.INFTY_COST
     return cost_matrix
@@ -211,4 +211,185 @@ class KalmanFilter(object):
             cholesky_factor, d.T, lower=True, check_finite=False,
             overwrite_b=True)
         squared_maha = np.sum(z * z, axis=0)
-        return squared_maha
\ No newline at end of file
+        return squared_maha
+
+    def multi_predict(self, mean, covariance):
+        """Run Kalman filter prediction step for N states at once.
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean vectors of the object states at the
+            previous time step.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices of the object states at
+            the previous time step.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the mean vectors and covariance matrices of the predicted
+            states.
+        """
+        std = np.stack([
+            self._std_weight_position * mean[:, 0],
+            self._std_weight_position * mean[:, 1],
+            1 * mean[:, 2],
+            self._std_weight_position * mean[:, 3],
+            self._std_weight_velocity * mean[:, 0],
+            self._std_weight_velocity * mean[:, 1],
+            0.1 * mean[:, 2],
+            self._std_weight_velocity * mean[:, 3]], axis=1)
+        motion_cov = np.zeros_like(covariance)
+        motion_cov[:, np.arange(8), np.arange(8)] = np.square(std)
+
+        mean = mean @ self._motion_mat.T
+        covariance = self._motion_mat @ covariance @ self._motion_mat.T + motion_cov
+        return mean, covariance
+
+    def multi_project(self, mean, covariance, confidence=.0):
+        """Project N state distributions to measurement space.
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean vectors.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices.
+        confidence : float or ndarray
+            Detection confidence, either a scalar or one value per state.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the Nx4 projected means and Nx4x4 covariance matrices of
+            the given state estimates.
+        """
+        std = np.stack([
+            self._std_weight_position * mean[:, 3],
+            self._std_weight_position * mean[:, 3],
+            np.full(len(mean), 1e-1),
+            self._std_weight_position * mean[:, 3]], axis=1)
+        std = (1 - np.reshape(confidence, (-1, 1))) * std
+
+        # the observation model keeps the first 4 state dimensions
+        projected_cov = covariance[:, :4, :4].copy()
+        projected_cov[:, np.arange(4), np.arange(4)] += np.square(std)
+        return mean[:, :4].copy(), projected_cov
+
+    def multi_update(self, mean, covariance, measurement, confidence=.0):
+        """Run Kalman filter correction step for N states at once.
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional predicted mean vectors.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices.
+        measurement : ndarray
+            The Nx4 dimensional measurements (x, y, a, h), one per state.
+        confidence : float or ndarray
+            Detection confidence, either a scalar or one value per state.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the measurement-corrected state distributions.
+        """
+        projected_mean, projected_cov = self.multi_project(mean, covariance, confidence)
+
+        # K = P H^T S^-1, solved as S K^T = H P^T since S is symmetric
+        kalman_gain = np.linalg.solve(
+            projected_cov, covariance[:, :4, :]).transpose(0, 2, 1)
+        innovation = measurement - projected_mean
+
+        new_mean = mean + (kalman_gain @ innovation[:, :, None])[:, :, 0]
+        new_covariance = covariance - kalman_gain @ projected_cov @ kalman_gain.transpose(0, 2, 1)
+        return new_mean, new_covariance
+
+    def multi_gating_distance(self, mean, covariance, measurements,
+                              only_position=False):
+        """Compute gating distances between N state distributions and M
+        measurements.
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean vectors.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices.
+        measurements : ndarray
+            An Mx4 dimensional matrix of M measurements in format (x, y, a, h).
+        only_position : Optional[bool]
+            If True, distance computation is done with respect to the bounding
+            box center position only.
+        Returns
+        -------
+        ndarray
+            Returns an NxM matrix, where element (i, j) contains the squared
+            Mahalanobis distance between state i and `measurements[j]`.
+        """
+        mean, covariance = self.multi_project(mean, covariance)
+
+        if only_position:
+            mean, covariance = mean[:, :2], covariance[:, :2, :2]
+            measurements = measurements[:, :2]
+
+        cholesky_factor = np.linalg.cholesky(covariance)
+        d = measurements[None, :, :] - mean[:, None, :]
+        z = np.linalg.solve(cholesky_factor, d.transpose(0, 2, 1))
+        squared_maha = np.sum(z * z, axis=1)
+        return squared_maha
+
+
+class KalmanStates(object):
+    """
+    Contiguous storage for the Kalman states of many tracks.
+
+    Means and covariances live in preallocated (capacity, 8) and
+    (capacity, 8, 8) arrays. Each track owns a slot, so that prediction and
+    correction run as a single batched operation over the given slots.
+
+    Parameters
+    ----------
+    kf : Optional[KalmanFilter]
+        The Kalman filter model. Defaults to a new `KalmanFilter`.
+    capacity : int
+        Initial number of slots, the storage doubles when it is full.
+
+    Attributes
+    ----------
+    mean : ndarray
+        The (capacity, 8) mean vectors, indexed by slot.
+    covariance : ndarray
+        The (capacity, 8, 8) covariance matrices, indexed by slot.
+    """
+
+    def __init__(self, kf=None, capacity=32):
+        self.kf = kf if kf is not None else KalmanFilter()
+        self.mean = np.zeros((capacity, 8))
+        self.covariance = np.zeros((capacity, 8, 8))
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def initiate(self, measurement):
+        """Create a state from an unassociated measurement and return its slot."""
+        if not self._free:
+            capacity = len(self.mean)
+            self.mean = np.concatenate([self.mean, np.zeros_like(self.mean)])
+            self.covariance = np.concatenate([self.covariance, np.zeros_like(self.covariance)])
+            self._free = list(range(2 * capacity - 1, capacity - 1, -1))
+        slot = self._free.pop()
+        self.mean[slot], self.covariance[slot] = self.kf.initiate(measurement)
+        return slot
+
+    def remove(self, slot):
+        """Release the slot of a deleted track."""
+        self._free.append(slot)
+
+    def predict(self, slots):
+        """Run the prediction step on the states of the given slots."""
+        if len(slots) == 0:
+            return
+        self.mean[slots], self.covariance[slots] = self.kf.multi_predict(
+            self.mean[slots], self.covariance[slots])
+
+    def update(self, slots, measurements, confidences):
+        """Run the correction step on the states of the given slots, with one
+        measurement and detection confidence per slot."""
+        if len(slots) == 0:
+            return
+        self.mean[slots], self.covariance[slots] = self.kf.multi_update(
+            self.mean[slots], self.covariance[slots], np.asarray(measurements), np.asarray(confidences))
@@ -2,15 +2,67 @@
 from __future__ import absolute_import
 import numpy as np
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from . import kalman_filter
 
 
 INFTY_COST = 1e+5
 
 
+def sparse_linear_sum_assignment(cost_matrix, max_distance):
+    """Solve the linear assignment problem on the feasible entries only.
+
+    Entries larger than `max_distance` are pruned, and every connected
+    component of the remaining bipartite track/detection graph is solved
+    separately. Infeasible pairs cannot improve the assignment, so this
+    reaches the same optimal cost as solving the whole gated matrix.
+
+    Parameters
+    ----------
+    cost_matrix : ndarray
+        The NxM dimensional cost matrix.
+    max_distance : float
+        Gating threshold. Entries with larger cost are infeasible.
+
+    Returns
+    -------
+    (ndarray, ndarray)
+        The row and column indices of the assignment, sorted by row. Only
+        rows and columns that have at least one feasible entry are assigned.
+    """
+    n_rows, n_cols = cost_matrix.shape
+    rows, cols = np.nonzero(cost_matrix <= max_distance)
+    if len(rows) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    graph = csr_matrix(
+        (np.ones(len(rows)), (rows, n_rows + cols)), shape=(n_rows + n_cols, n_rows + n_cols))
+    _, labels = connected_components(graph, directed=False)
+    row_labels, col_labels = labels[:n_rows], labels[n_rows:]
+
+    # group the rows and columns of each component that has feasible entries
+    components = np.unique(row_labels[rows])
+    row_order = np.argsort(row_labels, kind="stable")
+    col_order = np.argsort(col_labels, kind="stable")
+    row_bounds = np.searchsorted(row_labels[row_order], [components, components + 1])
+    col_bounds = np.searchsorted(col_labels[col_order], [components, components + 1])
+
+    row_indices, col_indices = [], []
+    for k in range(len(components)):
+        comp_rows = row_order[row_bounds[0, k]:row_bounds[1, k]]
+        comp_cols = col_order[col_bounds[0, k]:col_bounds[1, k]]
+        r, c = linear_sum_assignment(cost_matrix[np.ix_(comp_rows, comp_cols)])
+        row_indices.append(comp_rows[r])
+        col_indices.append(comp_cols[c])
+    row_indices, col_indices = np.concatenate(row_indices), np.concatenate(col_indices)
+    order = np.argsort(row_indices)
+    return row_indices[order], col_indices[order]
+
+
 def min_cost_matching(
         distance_metric, max_distance, tracks, detections, track_indices=None,
-        detection_indices=None):
+        detection_indices=None, sparse=False):
     """Solve linear assignment problem.
     Parameters
     ----------
@@ -23,8 +75,8 @@ def min_cost_matching(
     max_distance : float
         Gating threshold. Associations with cost larger than this value are
         disregarded.
-    tracks : List[track.Track]
-        A list of predicted tracks at the current time step.
+    tracks : track.TrackStore
+        The predicted tracks at the current time step.
     detections : List[detection.Detection]
         A list of detections at the current time step.
     track_indices : List[int]
@@ -33,6 +85,10 @@ def min_cost_matching(
     detection_indices : List[int]
         List of detection indices that maps columns in `cost_matrix` to
         detections in `detections` (see description above).
+    sparse : Optional[bool]
+        If True, solve the independent components of the gated cost matrix
+        separately (see `sparse_linear_sum_assignment`). Faster on large,
+        sparsely feasible matrices.
     Returns
     -------
     (List[(int, int)], List[int], List[int])
@@ -52,29 +108,29 @@ def min_cost_matching(
     cost_matrix = distance_metric(
         tracks, detections, track_indices, detection_indices)
     cost_matrix[cost_matrix > max_distance] = max_distance + 1e-5
-    row_indices, col_indices = linear_sum_assignment(cost_matrix)
-
-    matches, unmatched_tracks, unmatched_detections = [], [], []
-    for col, detection_idx in enumerate(detection_indices):
-        if col not in col_indices:
-            unmatched_detections.append(detection_idx)
-    for row, track_idx in enumerate(track_indices):
-        if row not in row_indices:
-            unmatched_tracks.append(track_idx)
-    for row, col in zip(row_indices, col_indices):
-        track_idx = track_indices[row]
-        detection_idx = detection_indices[col]
-        if cost_matrix[row, col] > max_distance:
-            unmatched_tracks.append(track_idx)
-            unmatched_detections.append(detection_idx)
-        else:
-            matches.append((track_idx, detection_idx))
+    if sparse:
+        row_indices, col_indices = sparse_linear_sum_assignment(cost_matrix, max_distance)
+    else:
+        row_indices, col_indices = linear_sum_assignment(cost_matrix)
+
+    assigned_rows = np.zeros(len(track_indices), dtype=bool)
+    assigned_rows[row_indices] = True
+    assigned_cols = np.zeros(len(detection_indices), dtype=bool)
+    assigned_cols[col_indices] = True
+    rejected = cost_matrix[row_indices, col_indices] > max_distance
+
+    matches = [(track_indices[row], detection_indices[col]) for row, col in
+               zip(row_indices[~rejected], col_indices[~rejected])]
+    unmatched_tracks = [track_indices[row] for row in np.flatnonzero(~assigned_rows)] + \
+        [track_indices[row] for row in row_indices[rejected]]
+    unmatched_detections = [detection_indices[col] for col in np.flatnonzero(~assigned_cols)] + \
+        [detection_indices[col] for col in col_indices[rejected]]
     return matches, unmatched_tracks, unmatched_detections
 
 
 def matching_cascade(
         distance_metric, max_distance, cascade_depth, tracks, detections,
-        track_indices=None, detection_indices=None):
+        track_indices=None, detection_indices=None, sparse=False):
     """Run matching cascade.
     Parameters
     ----------
@@ -89,8 +145,8 @@ def matching_cascade(
         disregarded.
     cascade_depth: int
         The cascade depth, should be se to the maximum track age.
-    tracks : List[track.Track]
-        A list of predicted tracks at the current time step.
+    tracks : track.TrackStore
+        The predicted tracks at the current time step.
     detections : List[detection.Detection]
         A list of detections at the current time step.
     track_indices : Optional[List[int]]
@@ -100,6 +156,8 @@ def matching_cascade(
         List of detection indices that maps columns in `cost_matrix` to
         detections in `detections` (see description above). Defaults to all
         detections.
+    sparse : Optional[bool]
+        If True, use the sparse assignment solver (see `min_cost_matching`).
     Returns
     -------
     (List[(int, int)], List[int], List[int])
@@ -122,14 +180,47 @@ def matching_cascade(
     matches_l, _, unmatched_detections = \
         min_cost_matching(
             distance_metric, max_distance, tracks, detections,
-            track_indices_l, unmatched_detections)
+            track_indices_l, unmatched_detections, sparse)
     matches += matches_l
     unmatched_tracks = list(set(track_indices) - set(k for k, _ in matches))
     return matches, unmatched_tracks, unmatched_detections
 
 
+def gating_distance_matrix(
+        kf, tracks, detections, track_indices, detection_indices,
+        only_position=False):
+    """Compute the squared Mahalanobis distance between the state
+    distributions of all given tracks and all given detections in one batched
+    pass.
+    Parameters
+    ----------
+    kf : The Kalman filter.
+    tracks : track.TrackStore
+        The predicted tracks at the current time step.
+    detections : List[detection.Detection]
+        A list of detections at the current time step.
+    track_indices : List[int]
+        List of track indices that maps rows to tracks in `tracks`.
+    detection_indices : List[int]
+        List of detection indices that maps columns to detections in
+        `detections`.
+    only_position : Optional[bool]
+        If True, only the x, y position of the state distribution is
+        considered. Defaults to False.
+    Returns
+    -------
+    ndarray
+        Returns the NxM matrix of squared Mahalanobis distances, where N is
+        the number of track indices and M the number of detection indices.
+    """
+    mean, covariance = tracks.kalman_state(track_indices)
+    measurements = np.asarray(
+        [detections[i].to_xyah() for i in detection_indices])
+    return kf.multi_gating_distance(mean, covariance, measurements, only_position)
+
+
 def gate_cost_matrix(
-        cost_matrix, tracks, detections, track_indices, detection_indices,
+        kf, cost_matrix, tracks, detections, track_indices, detection_indices,
         gated_cost=INFTY_COST, only_position=False):
     """Invalidate infeasible entries in cost matrix based on the state
     distributions obtained by Kalman filtering.
@@ -141,8 +232,8 @@ def gate_cost_matrix(
         and M is the number of detection indices, such that entry (i, j) is the
         association cost between `tracks[track_indices[i]]` and
         `detections[detection_indices[j]]`.
-    tracks : List[track.Track]
-        A list of predicted tracks at the current time step.
+    tracks : track.TrackStore
+        The predicted tracks at the current time step.
     detections : List[detection.Detection]
         A list of detections at the current time step.
     track_indices : List[int]
@@ -164,11 +255,9 @@ def gate_cost_matrix(
     """
     gating_dim = 2 if only_position else 4
     gating_threshold = kalman_filter.chi2inv95[gating_dim]
-    measurements = np.asarray(
-        [detections[i].to_xyah() for i in detection_indices])
-    for row, track_idx in enumerate(track_indices):
-        track = tracks[track_idx]
-        gating_distance = track.kf.gating_distance(track.mean, track.covariance, measurements, only_position)
-        cost_matrix[row, gating_distance > gating_threshold] = gated_cost
-        cost_matrix[row] = 0.995 * cost_matrix[row] + (1 - 0.995) *  gating_distance
+    gating_distance = gating_distance_matrix(
+        kf, tracks, detections, track_indices, detection_indices, only_position)
+    cost_matrix[gating_distance > gating_threshold] = gated_cost
+    cost_matrix *= 0.995
+    cost_matrix += (1 - 0.995) * gating_distance
     return cost_matrix
\ No newline at end of file
@@ -0,0 +1,193 @@
+# vim: expandtab:ts=4:sw=4
+import numpy as np
+
+
+def _kmeans(x, k, n_iter=10, seed=0):
+    """Cluster unit length row vectors with spherical k-means.
+
+    Returns
+    -------
+    ndarray
+        The kxM unit length centroids.
+    """
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)]
+    for _ in range(n_iter):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0  # keep the previous centroid of an empty cluster
+        sums[~empty] /= norms[~empty]
+        sums[empty] = centroids[empty]
+        centroids = sums
+    return centroids
+
+
+class LongTermMemory(object):
+    """
+    Appearance memory of deleted tracks, used to give a reappearing object
+    back its previous identity instead of a new one.
+
+    Every confirmed track that is deleted after `max_age` misses leaves its
+    smoothed appearance feature in the memory for `ttl` frames. At most
+    `capacity` tracks are kept, the oldest entry is evicted when the memory
+    is full. Queries are answered with one matrix product against all the
+    stored features or, with `nlist` > 0, against the features in the
+    `nprobe` closest inverted lists of a k-means coarse quantizer (IVF), which
+    keeps lookups cheap with tens of thousands of stored identities.
+
+    Parameters
+    ----------
+    max_distance : float
+        Cosine distance threshold, a detection is only re-identified with a
+        stored track closer than this.
+    ttl : Optional[int]
+        Number of frames a deleted track is remembered. If None, entries only
+        leave the memory when it is full.
+    capacity : int
+        Maximum number of remembered tracks.
+    nlist : int
+        Number of inverted lists of the index, 0 for exhaustive search. The
+        quantizer is trained once the memory holds `8 * nlist` tracks, the
+        search is exhaustive until then.
+    nprobe : int
+        Number of inverted lists searched per query.
+
+    Attributes
+    ----------
+    now : int
+        Current frame, advanced with `step`.
+    """
+
+    def __init__(self, max_distance=0.2, ttl=900, capacity=10000, nlist=0, nprobe=8):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.capacity = capacity
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.now = 0
+
+        self._features = None  # (rows, M) unit length features, allocated on first add
+        self._targets = np.full(min(capacity, 256), -1, dtype=np.int64)  # -1 marks a free row
+        self._classes = np.zeros(len(self._targets), dtype=np.int64)
+        self._time = np.zeros(len(self._targets), dtype=np.int64)  # frame the track was deleted
+        self._lists = np.zeros(len(self._targets), dtype=np.int64)  # inverted list of every row
+        self._centroids = None
+
+    def __len__(self):
+        return int((self._targets >= 0).sum())
+
+    def step(self):
+        """Advance the clock by one frame and forget the expired tracks."""
+        self.now += 1
+        if self.ttl is not None:
+            self._targets[self._time < self.now - self.ttl] = -1
+
+    def _rows(self, n):
+        """Return n free rows, growing the storage up to `capacity` and then
+        evicting the oldest entries."""
+        free = np.flatnonzero(self._targets < 0)
+        if len(free) < n and len(self._targets) < self.capacity:
+            size = min(max(2 * len(self._targets), len(self._targets) + n), self.capacity)
+            grow = size - len(self._targets)
+            self._targets = np.concatenate([self._targets, np.full(grow, -1, dtype=np.int64)])
+            self._classes, self._time, self._lists = (
+                np.concatenate([a, np.zeros(grow, dtype=a.dtype)]) for a in (self._classes, self._time, self._lists))
+            self._features = np.concatenate([self._features, np.zeros((grow, self._features.shape[1]), np.float32)])
+            free = np.flatnonzero(self._targets < 0)
+        if len(free) < n:
+            used = np.flatnonzero(self._targets >= 0)
+            oldest = used[np.argsort(self._time[used], kind='stable')[:n - len(free)]]
+            free = np.concatenate([free, oldest])
+        return free[:n]
+
+    def add(self, features, targets, classes):
+        """Remember deleted tracks.
+
+        Parameters
+        ----------
+        features : ndarray
+            An NxM matrix of the N appearance features of the tracks.
+        targets : ndarray
+            The N track identities.
+        classes : ndarray
+            The N track classes.
+        """
+        if len(targets) == 0 or self.capacity == 0:
+            return
+        features = np.asarray(features, dtype=np.float32)[-self.capacity:]
+        targets = np.asarray(targets, dtype=np.int64)[-self.capacity:]
+        features = features / np.linalg.norm(features, axis=1, keepdims=True)
+        if self._features is None:
+            self._features = np.zeros((len(self._targets), features.shape[1]), dtype=np.float32)
+
+        rows = self._rows(len(targets))
+        self._features[rows] = features
+        self._targets[rows] = targets
+        self._classes[rows] = np.asarray(classes, dtype=np.int64)[-self.capacity:]
+        self._time[rows] = self.now
+        if self._centroids is not None:
+            self._lists[rows] = np.argmax(features @ self._centroids.T, axis=1)
+        elif self.nlist > 0 and len(self) >= 8 * self.nlist:
+            used = np.flatnonzero(self._targets >= 0)
+            sample = np.random.RandomState(0).permutation(used)[:64 * self.nlist]
+            self._centroids = _kmeans(self._features[sample], self.nlist)
+            self._lists[used] = np.argmax(self._features[used] @ self._centroids.T, axis=1)
+
+    def query(self, features, classes):
+        """Re-identify detections with the remembered tracks.
+
+        Every detection is matched with its nearest stored track of the same
+        class. Detections that compete for the same track are resolved
+        greedily, closest first. Matched tracks are removed from the memory.
+
+        Parameters
+        ----------
+        features : ndarray
+            An NxM matrix of N detection features.
+        classes : ndarray
+            The N detection classes.
+
+        Returns
+        -------
+        ndarray
+            The N re-identified track identities, -1 for the detections
+            without a match closer than `max_distance`.
+        """
+        targets = np.full(len(features), -1, dtype=np.int64)
+        used = np.flatnonzero(self._targets >= 0)
+        if len(features) == 0 or len(used) == 0:
+            return targets
+
+        features = np.asarray(features, dtype=np.float32)
+        features = features / np.linalg.norm(features, axis=1, keepdims=True)
+        classes = np.asarray(classes, dtype=np.int64)
+        if self._centroids is None:  # exhaustive, one matrix product for all the detections
+            d = 1. - features @ self._features[used].T
+            d[classes[:, None] != self._classes[used][None, :]] = np.inf
+            k = np.argmin(d, axis=1)
+            best, distance = used[k], d[np.arange(len(features)), k]
+        else:
+            best = np.full(len(features), -1, dtype=np.int64)
+            distance = np.full(len(features), np.inf)
+            probe = np.argsort(-(features @ self._centroids.T), axis=1)[:, :self.nprobe]
+            probed = np.zeros((len(features), self.nlist), dtype=bool)
+            probed[np.arange(len(features))[:, None], probe] = True
+            candidates = probed[:, self._lists[used]] & (classes[:, None] == self._classes[used][None, :])
+            for i in range(len(features)):
+                rows = used[candidates[i]]
+                if len(rows) == 0:
+                    continue
+                d = 1. - self._features[rows] @ features[i]
+                k = np.argmin(d)
+                best[i], distance[i] = rows[k], d[k]
+
+        for i in np.argsort(distance, kind='stable'):
+            if distance[i] > self.max_distance:
+                break
+            row = best[i]
+            if self._targets[row] >= 0:  # not taken by a closer detection
+                targets[i] = self._targets[row]
+                self._targets[row] = -1
+        return targets
@@ -1,102 +1,19 @@
 # vim: expandtab:ts=4:sw=4
 import numpy as np
-import sys
-import torch
-sys.path.append('strong_sort/deep/reid')
-from torchreid.metrics.distance import compute_distance_matrix
-
-
-def _pdist(a, b):
-    """Compute pair-wise squared distance between points in `a` and `b`.
-    Parameters
-    ----------
-    a : array_like
-        An NxM matrix of N samples of dimensionality M.
-    b : array_like
-        An LxM matrix of L samples of dimensionality M.
-    Returns
-    -------
-    ndarray
-        Returns a matrix of size len(a), len(b) such that eleement (i, j)
-        contains the squared distance between `a[i]` and `b[j]`.
-    """
-    a, b = np.asarray(a), np.asarray(b)
-    if len(a) == 0 or len(b) == 0:
-        return np.zeros((len(a), len(b)))
-    a2, b2 = np.square(a).sum(axis=1), np.square(b).sum(axis=1)
-    r2 = -2. * np.dot(a, b.T) + a2[:, None] + b2[None, :]
-    r2 = np.clip(r2, 0., float(np.inf))
-    return r2
-
-
-def _cosine_distance(a, b, data_is_normalized=False):
-    """Compute pair-wise cosine distance between points in `a` and `b`.
-    Parameters
-    ----------
-    a : array_like
-        An NxM matrix of N samples of dimensionality M.
-    b : array_like
-        An LxM matrix of L samples of dimensionality M.
-    data_is_normalized : Optional[bool]
-        If True, assumes rows in a and b are unit length vectors.
-        Otherwise, a and b are explicitly normalized to lenght 1.
-    Returns
-    -------
-    ndarray
-        Returns a matrix of size len(a), len(b) such that eleement (i, j)
-        contains the squared distance between `a[i]` and `b[j]`.
-    """
-    if not data_is_normalized:
-        a = np.asarray(a) / np.linalg.norm(a, axis=1, keepdims=True)
-        b = np.asarray(b) / np.linalg.norm(b, axis=1, keepdims=True)
-    return 1. - np.dot(a, b.T)
-
-
-def _nn_euclidean_distance(x, y):
-    """ Helper function for nearest neighbor distance metric (Euclidean).
-    Parameters
-    ----------
-    x : ndarray
-        A matrix of N row-vectors (sample points).
-    y : ndarray
-        A matrix of M row-vectors (query points).
-    Returns
-    -------
-    ndarray
-        A vector of length M that contains for each entry in `y` the
-        smallest Euclidean distance to a sample in `x`.
-    """
-    x_ = torch.from_numpy(np.asarray(x) / np.linalg.norm(x, axis=1, keepdims=True))
-    y_ = torch.from_numpy(np.asarray(y) / np.linalg.norm(y, axis=1, keepdims=True))
-    distances = compute_distance_matrix(x_, y_, metric='euclidean')
-    return np.maximum(0.0, torch.min(distances, axis=0)[0].numpy())
-
-
-def _nn_cosine_distance(x, y):
-    """ Helper function for nearest neighbor distance metric (cosine).
-    Parameters
-    ----------
-    x : ndarray
-        A matrix of N row-vectors (sample points).
-    y : ndarray
-        A matrix of M row-vectors (query points).
-    Returns
-    -------
-    ndarray
-        A vector of length M that contains for each entry in `y` the
-        smallest cosine distance to a sample in `x`.
-    """
-    x_ = torch.from_numpy(np.asarray(x))
-    y_ = torch.from_numpy(np.asarray(y))
-    distances = compute_distance_matrix(x_, y_, metric='cosine')
-    distances = distances.cpu().detach().numpy()
-    return distances.min(axis=0)
 
 
 class NearestNeighborDistanceMetric(object):
     """
     A nearest neighbor distance metric that, for each target, returns
     the closest distance to any sample that has been observed so far.
+
+    Every target owns a persistent slot of a preallocated gallery of unit
+    length features, holding its samples in a ring of `budget` rows. Samples
+    are written in place with `add` and slots are released with `remove`, so
+    that steady-state updates allocate no gallery memory. Distances of all
+    detections to all targets are computed with one batched matrix product
+    followed by a per-target minimum.
+
     Parameters
     ----------
     metric : str
@@ -107,6 +24,8 @@ class NearestNeighborDistanceMetric(object):
     budget : Optional[int]
         If not None, fix samples per class to at most this number. Removes
         the oldest samples when the budget is reached.
+    capacity : int
+        Initial number of target slots, the gallery doubles when it is full.
     Attributes
     ----------
     samples : Dict[int -> List[ndarray]]
@@ -114,17 +33,78 @@ class NearestNeighborDistanceMetric(object):
         that have been observed so far.
     """
 
-    def __init__(self, metric, matching_threshold, budget=None):
-        if metric == "euclidean":
-            self._metric = _nn_euclidean_distance
-        elif metric == "cosine":
-            self._metric = _nn_cosine_distance
-        else:
+    def __init__(self, metric, matching_threshold, budget=None, capacity=64):
+        if metric not in ("euclidean", "cosine"):
             raise ValueError(
                 "Invalid metric; must be either 'euclidean' or 'cosine'")
+        self.metric = metric
         self.matching_threshold = matching_threshold
         self.budget = budget
-        self.samples = {}
+
+        self._rows = budget if budget is not None else 16  # ring length, grows if there is no budget
+        self._gallery = None  # (capacity, rows, M) unit length samples, allocated on first add
+        self._counts = np.zeros(capacity, dtype=np.int64)  # samples written to each slot
+        self._slots = {}  # target -> slot
+        self._free = list(range(capacity - 1, -1, -1))
+
+    @property
+    def samples(self):
+        samples = {}
+        for target, slot in self._slots.items():
+            count = self._counts[slot]
+            if count == 0:
+                continue
+            ring = self._gallery[slot, :min(count, self._rows)]
+            samples[target] = list(np.roll(ring, -(count % self._rows), axis=0) if count > self._rows else ring)
+        return samples
+
+    def _slot(self, target):
+        """Return the slot of a target, allocating one if needed."""
+        slot = self._slots.get(target)
+        if slot is None:
+            if not self._free:
+                capacity = len(self._counts)
+                self._gallery = np.concatenate([self._gallery, np.zeros_like(self._gallery)])
+                self._counts = np.concatenate([self._counts, np.zeros_like(self._counts)])
+                self._free = list(range(2 * capacity - 1, capacity - 1, -1))
+            slot = self._slots[target] = self._free.pop()
+        return slot
+
+    def add(self, features, targets):
+        """Write one new sample for each of the given targets.
+        Parameters
+        ----------
+        features : ndarray
+            An NxM matrix of N features of dimensionality M.
+        targets : ndarray
+            An integer array of N distinct target identities.
+        """
+        if len(targets) == 0:
+            return
+        features = np.asarray(features, dtype=np.float32)
+        if self._gallery is None:
+            self._gallery = np.zeros((len(self._counts), self._rows, features.shape[1]), dtype=np.float32)
+        slots = np.array([self._slot(int(t)) for t in targets], dtype=np.int64)
+        if self.budget is None and self._counts[slots].max() >= self._rows:  # no budget, keep every sample
+            self._gallery = np.concatenate([self._gallery, np.zeros_like(self._gallery)], axis=1)
+            self._rows *= 2
+        rows = self._counts[slots] % self._rows  # the oldest sample is overwritten once the ring is full
+        self._gallery[slots, rows] = features / np.linalg.norm(features, axis=1, keepdims=True)
+        self._counts[slots] += 1
+
+    def count(self, targets):
+        """Return the number of samples written for each of the given targets,
+        0 for unknown targets."""
+        return np.array([self._counts[self._slots[int(t)]] if int(t) in self._slots else 0 for t in targets],
+                        dtype=np.int64)
+
+    def remove(self, targets):
+        """Forget the samples of the given targets and release their slots."""
+        for target in targets:
+            slot = self._slots.pop(int(target), None)
+            if slot is not None:
+                self._counts[slot] = 0
+                self._free.append(slot)
 
     def partial_fit(self, features, targets, active_targets):
         """Update the distance metric with new data.
@@ -137,11 +117,10 @@ class NearestNeighborDistanceMetric(object):
         active_targets : List[int]
             A list of targets that are currently present in the scene.
         """
-        for feature, target in zip(features, targets):
-            self.samples.setdefault(target, []).append(feature)
-            if self.budget is not None:
-                self.samples[target] = self.samples[target][-self.budget:]
-        self.samples = {k: self.samples[k] for k in active_targets}
+        active_targets = set(int(t) for t in active_targets)
+        self.remove([t for t in self._slots if t not in active_targets])
+        for feature, target in zip(np.asarray(features), np.asarray(targets)):
+            self.add(feature[None], [target])
 
     def distance(self, features, targets):
         """Compute distance between features and targets.
@@ -158,7 +137,20 @@ class NearestNeighborDistanceMetric(object):
             element (i, j) contains the closest squared distance between
             `targets[i]` and `features[j]`.
         """
-        cost_matrix = np.zeros((len(targets), len(features)))
-        for i, target in enumerate(targets):
-            cost_matrix[i, :] = self._metric(self.samples[target], features)
-        return cost_matrix
\ No newline at end of file
+        slots = np.array([self._slots.get(int(t), -1) for t in targets], dtype=np.int64)
+        cost_matrix = np.full((len(slots), len(features)), np.inf)
+        known = np.flatnonzero(slots >= 0)
+        if len(known) == 0 or len(features) == 0:
+            return cost_matrix
+
+        features = np.asarray(features, dtype=np.float32)
+        features = features / np.linalg.norm(features, axis=1, keepdims=True)
+        similarity = self._gallery[slots[known]] @ features.T  # (targets, rows, features), one batched GEMM
+        if self.metric == "cosine":
+            distances = 1. - similarity
+        else:
+            distances = np.maximum(0., 2. - 2. * similarity)
+        filled = np.arange(self._rows)[None, :] < self._counts[slots[known]][:, None]
+        distances[~filled] = np.inf
+        cost_matrix[known] = distances.min(axis=1)
+        return cost_matrix
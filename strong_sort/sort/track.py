@@ -1,7 +1,6 @@
 # vim: expandtab:ts=4:sw=4
-import cv2
 import numpy as np
-from strong_sort.sort.kalman_filter import KalmanFilter
+from strong_sort.sort.kalman_filter import KalmanStates
 
 
 class TrackState:
@@ -19,275 +18,339 @@ class TrackState:
     Deleted = 3
 
 
-class Track:
+def _column(name):
+    # Live rows of a column of the store, as a writable view
+    def fget(self):
+        return self._columns[name][:self.size]
+
+    def fset(self, value):
+        self._columns[name][:self.size] = value
+
+    return property(fget, fset, doc=f"ndarray : The `{name}` of every track, indexed by track position.")
+
+
+class TrackStore:
     """
-    A single target track with state space `(x, y, a, h)` and associated
-    velocities, where `(x, y)` is the center of the bounding box, `a` is the
-    aspect ratio and `h` is the height.
+    Structure-of-arrays storage of all the tracks of a tracker, each track
+    with state space `(x, y, a, h)` and associated velocities, where `(x, y)`
+    is the center of the bounding box, `a` is the aspect ratio and `h` is the
+    height.
+
+    Tracks occupy the rows `0 .. len(store) - 1` in creation order. Every
+    attribute is a column array indexed by track position, so that the state
+    bookkeeping of all tracks runs as vectorized operations. Deleted tracks
+    are dropped with `remove_deleted`, which keeps the order of the others.
 
     Parameters
     ----------
-    mean : ndarray
-        Mean vector of the initial state distribution.
-    covariance : ndarray
-        Covariance matrix of the initial state distribution.
-    track_id : int
-        A unique track identifier.
+    states : Optional[kalman_filter.KalmanStates]
+        Shared storage the Kalman states of the tracks are kept in. Defaults
+        to a private storage.
     n_init : int
-        Number of consecutive detections before the track is confirmed. The
+        Number of consecutive detections before a track is confirmed. The
         track state is set to `Deleted` if a miss occurs within the first
         `n_init` frames.
     max_age : int
         The maximum number of consecutive misses before the track state is
         set to `Deleted`.
-    feature : Optional[ndarray]
-        Feature vector of the detection this track originates from. If not None,
-        this feature is added to the `features` cache.
+    ema_alpha : float
+        Weight of the previous appearance feature in its exponential moving
+        average.
+    capacity : int
+        Initial number of rows, the storage doubles when it is full.
 
     Attributes
     ----------
-    mean : ndarray
-        Mean vector of the initial state distribution.
-    covariance : ndarray
-        Covariance matrix of the initial state distribution.
-    track_id : int
-        A unique track identifier.
-    hits : int
+    track_id : ndarray
+        The unique track identifiers.
+    class_id : ndarray
+        The class of the last associated detection.
+    conf : ndarray
+        The confidence of the last associated detection.
+    hits : ndarray
         Total number of measurement updates.
-    age : int
+    age : ndarray
         Total number of frames since first occurance.
-    time_since_update : int
+    time_since_update : ndarray
         Total number of frames since last measurement update.
-    state : TrackState
-        The current track state.
-    features : List[ndarray]
-        A cache of features. On each measurement update, the associated feature
-        vector is added to this list.
+    state : ndarray
+        The current `TrackState` of every track.
+    slot : ndarray
+        Index of the Kalman state of every track in `states`.
+    features : ndarray
+        The normalized, exponentially smoothed appearance feature of every
+        track.
+    feature_age : ndarray
+        Number of frames since the appearance feature was last updated with a
+        freshly extracted detection feature.
 
     """
 
-    def __init__(self, detection, track_id, class_id, conf, n_init, max_age, ema_alpha,
-                 feature=None):
-        self.track_id = track_id
-        self.class_id = int(class_id)
-        self.hits = 1
-        self.age = 1
-        self.time_since_update = 0
+    COLUMNS = (('track_id', np.int64), ('class_id', np.int64), ('conf', np.float64), ('hits', np.int64),
+               ('age', np.int64), ('time_since_update', np.int64), ('state', np.int8), ('slot', np.int64),
+               ('feature_age', np.int64))
+
+    track_id = _column('track_id')
+    class_id = _column('class_id')
+    conf = _column('conf')
+    hits = _column('hits')
+    age = _column('age')
+    time_since_update = _column('time_since_update')
+    state = _column('state')
+    slot = _column('slot')
+    features = _column('features')
+    feature_age = _column('feature_age')
+
+    def __init__(self, states=None, n_init=3, max_age=30, ema_alpha=0.9, capacity=32):
+        self.states = states if states is not None else KalmanStates()
+        self._n_init = n_init
+        self._max_age = max_age
         self.ema_alpha = ema_alpha
+        self.size = 0
+        self._columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.COLUMNS}
+        self._columns['features'] = np.zeros((capacity, 0), dtype=np.float32)  # D is set by the first feature
 
-        self.state = TrackState.Tentative
-        self.features = []
-        if feature is not None:
-            feature /= np.linalg.norm(feature)
-            self.features.append(feature)
+    def __len__(self):
+        return self.size
 
-        self.conf = conf
-        self._n_init = n_init
-        self._max_age = max_age
+    def __getitem__(self, index):
+        if not -self.size <= index < self.size:
+            raise IndexError('track index out of range')
+        return Track(self, index % self.size)
 
-        self.kf = KalmanFilter()
-        self.mean, self.covariance = self.kf.initiate(detection)
+    def __iter__(self):
+        return (Track(self, i) for i in range(self.size))
 
-    def to_tlwh(self):
-        """Get current position in bounding box format `(top left x, top left y,
-        width, height)`.
+    def confirmed(self):
+        """Returns the mask of confirmed tracks."""
+        return self.state == TrackState.Confirmed
+
+    def tentative(self):
+        """Returns the mask of tentative (unconfirmed) tracks."""
+        return self.state == TrackState.Tentative
+
+    def deleted(self):
+        """Returns the mask of dead tracks that should be deleted."""
+        return self.state == TrackState.Deleted
+
+    def add(self, measurement, track_id, class_id, conf, feature):
+        """Create a tentative track from an unassociated measurement.
+
+        Parameters
+        ----------
+        measurement : ndarray
+            Bounding box `(x, y, a, h)` the initial state distribution is
+            created from.
+        track_id : int
+            A unique track identifier.
+        class_id : int
+            Class of the detection.
+        conf : float
+            Confidence of the detection.
+        feature : ndarray
+            Feature vector of the detection the track originates from.
 
         Returns
         -------
-        ndarray
-            The bounding box.
+        int
+            The position of the new track.
 
         """
-        ret = self.mean[:4].copy()
-        ret[2] *= ret[3]
-        ret[:2] -= ret[2:] / 2
-        return ret
-
-    def to_tlbr(self):
-        """Get kf estimated current position in bounding box format `(min x, miny, max x,
-        max y)`.
+        feature = feature / np.linalg.norm(feature)
+        if self._columns['features'].shape[1] != len(feature):
+            self._columns['features'] = np.zeros((len(self._columns['slot']), len(feature)), dtype=feature.dtype)
+        if self.size == len(self._columns['slot']):
+            for name, column in self._columns.items():
+                self._columns[name] = np.concatenate([column, np.zeros_like(column)])
+
+        i = self.size
+        self.size += 1
+        self.track_id[i] = track_id
+        self.class_id[i] = class_id
+        self.conf[i] = conf
+        self.hits[i] = 1
+        self.age[i] = 1
+        self.time_since_update[i] = 0
+        self.state[i] = TrackState.Tentative
+        self.slot[i] = self.states.initiate(measurement)
+        self.features[i] = feature
+        self.feature_age[i] = 0
+        return i
+
+    def kalman_state(self, indices=None):
+        """Returns the mean vectors and covariance matrices of the given
+        tracks, all tracks by default."""
+        slots = self.slot if indices is None else self.slot[np.asarray(indices, dtype=np.int64)]
+        return self.states.mean[slots], self.states.covariance[slots]
+
+    def to_tlwh(self, indices=None):
+        """Get current position of the given tracks, all tracks by default, in
+        bounding box format `(top left x, top left y, width, height)`.
 
         Returns
         -------
         ndarray
-            The predicted kf bounding box.
+            The Nx4 bounding boxes.
 
         """
-        ret = self.to_tlwh()
-        ret[2:] = ret[:2] + ret[2:]
+        mean, _ = self.kalman_state(indices)
+        ret = mean[:, :4].copy()
+        ret[:, 2] *= ret[:, 3]
+        ret[:, :2] -= ret[:, 2:] / 2
         return ret
 
+    def to_tlbr(self, indices=None):
+        """Get kf estimated current position of the given tracks, all tracks by
+        default, in bounding box format `(min x, miny, max x, max y)`.
 
-    def ECC(self, src, dst, warp_mode = cv2.MOTION_EUCLIDEAN, eps = 1e-5,
-        max_iter = 100, scale = 0.1, align = False):
-        """Compute the warp matrix from src to dst.
-        Parameters
-        ----------
-        src : ndarray 
-            An NxM matrix of source img(BGR or Gray), it must be the same format as dst.
-        dst : ndarray
-            An NxM matrix of target img(BGR or Gray).
-        warp_mode: flags of opencv
-            translation: cv2.MOTION_TRANSLATION
-            rotated and shifted: cv2.MOTION_EUCLIDEAN
-            affine(shift,rotated,shear): cv2.MOTION_AFFINE
-            homography(3d): cv2.MOTION_HOMOGRAPHY
-        eps: float
-            the threshold of the increment in the correlation coefficient between two iterations
-        max_iter: int
-            the number of iterations.
-        scale: float or [int, int]
-            scale_ratio: float
-            scale_size: [W, H]
-        align: bool
-            whether to warp affine or perspective transforms to the source image
         Returns
         -------
-        warp matrix : ndarray
-            Returns the warp matrix from src to dst.
-            if motion models is homography, the warp matrix will be 3x3, otherwise 2x3
-        src_aligned: ndarray
-            aligned source image of gray
-        """
+        ndarray
+            The Nx4 predicted kf bounding boxes.
 
-        # skip if current and previous frame are not initialized (1st inference)
-        if (src.any() or dst.any() is None):
-            return None, None
-        # skip if current and previous fames are not the same size
-        elif (src.shape != dst.shape):
-            return None, None
-
-        # BGR2GRAY
-        if src.ndim == 3:
-            # Convert images to grayscale
-            src = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
-            dst = cv2.cvtColor(dst, cv2.COLOR_BGR2GRAY)
-
-        # make the imgs smaller to speed up
-        if scale is not None:
-            if isinstance(scale, float) or isinstance(scale, int):
-                if scale != 1:
-                    src_r = cv2.resize(src, (0, 0), fx = scale, fy = scale,interpolation =  cv2.INTER_LINEAR)
-                    dst_r = cv2.resize(dst, (0, 0), fx = scale, fy = scale,interpolation =  cv2.INTER_LINEAR)
-                    scale = [scale, scale]
-                else:
-                    src_r, dst_r = src, dst
-                    scale = None
-            else:
-                if scale[0] != src.shape[1] and scale[1] != src.shape[0]:
-                    src_r = cv2.resize(src, (scale[0], scale[1]), interpolation = cv2.INTER_LINEAR)
-                    dst_r = cv2.resize(dst, (scale[0], scale[1]), interpolation=cv2.INTER_LINEAR)
-                    scale = [scale[0] / src.shape[1], scale[1] / src.shape[0]]
-                else:
-                    src_r, dst_r = src, dst
-                    scale = None
-        else:
-            src_r, dst_r = src, dst
-
-        # Define 2x3 or 3x3 matrices and initialize the matrix to identity
-        if warp_mode == cv2.MOTION_HOMOGRAPHY :
-            warp_matrix = np.eye(3, 3, dtype=np.float32)
-        else :
-            warp_matrix = np.eye(2, 3, dtype=np.float32)
-
-        # Define termination criteria
-        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, max_iter, eps)
-
-        # Run the ECC algorithm. The results are stored in warp_matrix.
-        try:
-            (cc, warp_matrix) = cv2.findTransformECC (src_r, dst_r, warp_matrix, warp_mode, criteria, None, 1)
-        except cv2.error as e:
-            return None, None
-        
-
-        if scale is not None:
-            warp_matrix[0, 2] = warp_matrix[0, 2] / scale[0]
-            warp_matrix[1, 2] = warp_matrix[1, 2] / scale[1]
-
-        if align:
-            sz = src.shape
-            if warp_mode == cv2.MOTION_HOMOGRAPHY:
-                # Use warpPerspective for Homography
-                src_aligned = cv2.warpPerspective(src, warp_matrix, (sz[1],sz[0]), flags=cv2.INTER_LINEAR)
-            else :
-                # Use warpAffine for Translation, Euclidean and Affine
-                src_aligned = cv2.warpAffine(src, warp_matrix, (sz[1],sz[0]), flags=cv2.INTER_LINEAR)
-            return warp_matrix, src_aligned
-        else:
-            return warp_matrix, None
-
-    def get_matrix(self, matrix):
-        eye = np.eye(3)
-        dist = np.linalg.norm(eye - matrix)
-        if dist < 100:
-            return matrix
-        else:
-            return eye
-
-    def camera_update(self, previous_frame, next_frame):
-        warp_matrix, src_aligned = self.ECC(previous_frame, next_frame)
-        if warp_matrix is None and src_aligned is None:
-            return
-        [a,b] = warp_matrix
-        warp_matrix=np.array([a,b,[0,0,1]])
-        warp_matrix = warp_matrix.tolist()
-        matrix = self.get_matrix(warp_matrix)
-
-        x1, y1, x2, y2 = self.to_tlbr()
-        x1_, y1_, _ = matrix @ np.array([x1, y1, 1]).T
-        x2_, y2_, _ = matrix @ np.array([x2, y2, 1]).T
-        w, h = x2_ - x1_, y2_ - y1_
-        cx, cy = x1_ + w / 2, y1_ + h / 2
-        self.mean[:4] = [cx, cy, w / h, h]
+        """
+        ret = self.to_tlwh(indices)
+        ret[:, 2:] = ret[:, :2] + ret[:, 2:]
+        return ret
 
     def increment_age(self):
         self.age += 1
         self.time_since_update += 1
+        self.feature_age += 1
+
+    def predict(self):
+        """Propagate the state distributions of all tracks to the current time
+        step using a batched Kalman filter prediction step.
+        """
+        self.states.predict(self.slot)
+        self.increment_age()
 
-    def predict(self, kf):
-        """Propagate the state distribution to the current time step using a
-        Kalman filter prediction step.
+    def update(self, indices, features, class_ids, confs, fresh=None):
+        """Update the feature and the state bookkeeping of the given tracks
+        after an association. The Kalman filter measurement update is run by
+        the tracker, batched over all matched tracks.
 
         Parameters
         ----------
-        kf : kalman_filter.KalmanFilter
-            The Kalman filter.
+        indices : ndarray
+            Positions of the associated tracks.
+        features : ndarray
+            The NxD feature vectors of the associated detections.
+        class_ids : ndarray
+            Classes of the associated detections.
+        confs : ndarray
+            Confidences of the associated detections.
+        fresh : Optional[ndarray]
+            Mask of the detections whose feature was extracted in this frame
+            rather than reused from the track, all of them by default.
 
         """
-        self.mean, self.covariance = self.kf.predict(self.mean, self.covariance)
-        self.age += 1
-        self.time_since_update += 1
-
-    def update(self, detection, class_id, conf):
-        """Perform Kalman filter measurement update step and update the feature
-        cache.
-        Parameters
-        ----------
-        detection : Detection
-            The associated detection.
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return
+        self.conf[indices] = confs
+        self.class_id[indices] = class_ids
+
+        features = features / np.linalg.norm(features, axis=1, keepdims=True)
+        smooth_feat = self.ema_alpha * self.features[indices] + (1 - self.ema_alpha) * features
+        smooth_feat /= np.linalg.norm(smooth_feat, axis=1, keepdims=True)
+        self.features[indices] = smooth_feat
+        self.feature_age[indices if fresh is None else indices[fresh]] = 0
+
+        self.hits[indices] += 1
+        self.time_since_update[indices] = 0
+        confirm = indices[(self.state[indices] == TrackState.Tentative) & (self.hits[indices] >= self._n_init)]
+        self.state[confirm] = TrackState.Confirmed
+
+    def mark_missed(self, indices=None):
+        """Mark the given tracks, all tracks by default, as missed (no
+        association at the current time step).
         """
-        self.conf = conf
-        self.class_id = class_id.int()
-        self.mean, self.covariance = self.kf.update(self.mean, self.covariance, detection.to_xyah(), detection.confidence)
+        indices = np.arange(self.size) if indices is None else np.asarray(indices, dtype=np.int64)
+        state = self.state[indices]
+        dead = (state == TrackState.Tentative) | (self.time_since_update[indices] > self._max_age)
+        self.state[indices[dead]] = TrackState.Deleted
+
+    def remove_deleted(self):
+        """Drop the deleted tracks and release their Kalman states, the
+        remaining tracks keep their order."""
+        deleted = self.deleted()
+        if not deleted.any():
+            return
+        for slot in self.slot[deleted]:
+            self.states.remove(slot)
+        keep = np.flatnonzero(~deleted)
+        for column in self._columns.values():
+            column[:len(keep)] = column[keep]
+        self.size = len(keep)
+
+
+class Track:
+    """
+    View of a single track of a `TrackStore`, with state space `(x, y, a, h)`
+    and associated velocities, where `(x, y)` is the center of the bounding
+    box, `a` is the aspect ratio and `h` is the height. The view is only valid
+    until the store drops deleted tracks.
+
+    Parameters
+    ----------
+    store : TrackStore
+        The store the track lives in.
+    index : int
+        Position of the track in `store`.
+
+    """
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    track_id = property(lambda self: int(self.store.track_id[self.index]))
+    class_id = property(lambda self: int(self.store.class_id[self.index]))
+    conf = property(lambda self: float(self.store.conf[self.index]))
+    hits = property(lambda self: int(self.store.hits[self.index]))
+    age = property(lambda self: int(self.store.age[self.index]))
+    time_since_update = property(lambda self: int(self.store.time_since_update[self.index]))
+    state = property(lambda self: int(self.store.state[self.index]))
+    slot = property(lambda self: int(self.store.slot[self.index]))
+
+    @property
+    def mean(self):
+        return self.store.states.mean[self.slot]
 
-        feature = detection.feature / np.linalg.norm(detection.feature)
+    @property
+    def covariance(self):
+        return self.store.states.covariance[self.slot]
 
-        smooth_feat = self.ema_alpha * self.features[-1] + (1 - self.ema_alpha) * feature
-        smooth_feat /= np.linalg.norm(smooth_feat)
-        self.features = [smooth_feat]
+    @property
+    def features(self):
+        return [self.store.features[self.index]]
 
-        self.hits += 1
-        self.time_since_update = 0
-        if self.state == TrackState.Tentative and self.hits >= self._n_init:
-            self.state = TrackState.Confirmed
+    def to_tlwh(self):
+        """Get current position in bounding box format `(top left x, top left y,
+        width, height)`.
+
+        Returns
+        -------
+        ndarray
+            The bounding box.
+
+        """
+        return self.store.to_tlwh([self.index])[0]
+
+    def to_tlbr(self):
+        """Get kf estimated current position in bounding box format `(min x, miny, max x,
+        max y)`.
+
+        Returns
+        -------
+        ndarray
+            The predicted kf bounding box.
 
-    def mark_missed(self):
-        """Mark this track as missed (no association at the current time step).
         """
-        if self.state == TrackState.Tentative:
-            self.state = TrackState.Deleted
-        elif self.time_since_update > self._max_age:
-            self.state = TrackState.Deleted
+        return self.store.to_tlbr([self.index])[0]
 
     def is_tentative(self):
         """Returns True if this track is tentative (unconfirmed).
@@ -4,7 +4,8 @@ import numpy as np
 from . import kalman_filter
 from . import linear_assignment
 from . import iou_matching
-from .track import Track
+from .camera_motion import CameraMotionEstimator
+from .track import TrackState, TrackStore
 
 
 class Tracker:
@@ -20,6 +21,12 @@ class Tracker:
         Number of consecutive detections before the track is confirmed. The
         track state is set to `Deleted` if a miss occurs within the first
         `n_init` frames.
+    sparse_matching : bool
+        If True, solve the independent components of the gated cost matrices
+        separately during association.
+    memory : Optional[long_term_memory.LongTermMemory]
+        If not None, deleted tracks are remembered and new detections that
+        match one of them get its identity back.
     Attributes
     ----------
     metric : nn_matching.NearestNeighborDistanceMetric
@@ -30,12 +37,17 @@ class Tracker:
         Number of frames that a track remains in initialization phase.
     kf : kalman_filter.KalmanFilter
         A Kalman filter to filter target trajectories in image space.
-    tracks : List[Track]
-        The list of active tracks at the current time step.
+    states : kalman_filter.KalmanStates
+        Contiguous storage of the Kalman states of all tracks.
+    cmc : camera_motion.CameraMotionEstimator
+        Estimates the camera motion between consecutive frames.
+    tracks : TrackStore
+        The active tracks at the current time step.
     """
     GATING_THRESHOLD = np.sqrt(kalman_filter.chi2inv95[4])
 
-    def __init__(self, metric, max_iou_distance=0.9, max_age=30, n_init=3, _lambda=0, ema_alpha=0.9, mc_lambda=0.995):
+    def __init__(self, metric, max_iou_distance=0.9, max_age=30, n_init=3, _lambda=0, ema_alpha=0.9, mc_lambda=0.995,
+                 sparse_matching=False, memory=None):
         self.metric = metric
         self.max_iou_distance = max_iou_distance
         self.max_age = max_age
@@ -43,9 +55,13 @@ class Tracker:
         self._lambda = _lambda
         self.ema_alpha = ema_alpha
         self.mc_lambda = mc_lambda
+        self.sparse_matching = sparse_matching
+        self.memory = memory
 
         self.kf = kalman_filter.KalmanFilter()
-        self.tracks = []
+        self.states = kalman_filter.KalmanStates(self.kf)
+        self.cmc = CameraMotionEstimator()
+        self.tracks = TrackStore(self.states, n_init, max_age, ema_alpha)
         self._next_id = 1
 
     def predict(self):
@@ -53,17 +69,29 @@ class Tracker:
 
         This function should be called once every time step, before `update`.
         """
-        for track in self.tracks:
-            track.predict(self.kf)
+        self.tracks.predict()
+        if self.memory is not None:
+            self.memory.step()
 
     def increment_ages(self):
-        for track in self.tracks:
-            track.increment_age()
-            track.mark_missed()
+        self.tracks.increment_age()
+        self.tracks.mark_missed()
+        if self.memory is not None:
+            self.memory.step()
 
     def camera_update(self, previous_img, current_img):
-        for track in self.tracks:
-            track.camera_update(previous_img, current_img)
+        """Compensate the camera motion between two frames.
+
+        The warp is estimated once per frame and applied to all tracks at once.
+        This function should be called once every time step, even when there
+        are no tracks, so that the previous frame stays cached.
+        """
+        matrix = self.cmc.estimate(previous_img, current_img)
+        if matrix is None or len(self.tracks) == 0:
+            return
+        slots = self.tracks.slot
+        self.states.mean[slots], self.states.covariance[slots] = self.cmc.apply(
+            matrix, self.states.mean[slots], self.states.covariance[slots])
 
     def update(self, detections, classes, confidences):
         """Perform measurement update and track management.
@@ -78,26 +106,40 @@ class Tracker:
         matches, unmatched_tracks, unmatched_detections = \
             self._match(detections)
 
-        # Update track set.
-        for track_idx, detection_idx in matches:
-            self.tracks[track_idx].update(
-                detections[detection_idx], classes[detection_idx], confidences[detection_idx])
-        for track_idx in unmatched_tracks:
-            self.tracks[track_idx].mark_missed()
-        for detection_idx in unmatched_detections:
-            self._initiate_track(detections[detection_idx], classes[detection_idx].item(), confidences[detection_idx].item())
-
-        self.tracks = [t for t in self.tracks if not t.is_deleted()]
-
-        # Update distance metric.
-        active_targets = [t.track_id for t in self.tracks if t.is_confirmed()]
-        features, targets = [], []
-        for track in self.tracks:
-            if not track.is_confirmed():
-                continue
-            features += track.features
-            targets += [track.track_id for _ in track.features]
-        self.metric.partial_fit(np.asarray(features), np.asarray(targets), active_targets)
+        # Update track set, with one batched Kalman correction for all matches.
+        track_idx = np.array([k for k, _ in matches], dtype=np.int64)
+        detection_idx = np.array([k for _, k in matches], dtype=np.int64)
+        self.states.update(
+            self.tracks.slot[track_idx],
+            [detections[k].to_xyah() for k in detection_idx],
+            [detections[k].confidence for k in detection_idx])
+        fresh = np.array([not detections[k].cached for k in detection_idx], dtype=bool)
+        self.tracks.update(
+            track_idx, np.array([detections[k].feature for k in detection_idx]),
+            np.asarray(classes)[detection_idx], np.asarray(confidences)[detection_idx], fresh)
+        self.tracks.mark_missed(unmatched_tracks)
+
+        # Update distance metric in place: new samples of the confirmed tracks whose feature changed
+        # (or that have none yet), deleted tracks release their gallery slot.
+        confirmed = self.tracks.state[track_idx] == TrackState.Confirmed
+        matched = track_idx[confirmed & (fresh | (self.metric.count(self.tracks.track_id[track_idx]) == 0))]
+        self.metric.add(self.tracks.features[matched], self.tracks.track_id[matched])
+        deleted = self.tracks.deleted()
+        self.metric.remove(self.tracks.track_id[deleted])
+        if self.memory is not None:  # confirmed tracks are only deleted after max_age misses
+            lost = deleted & (self.tracks.time_since_update > self.max_age)
+            self.memory.add(self.tracks.features[lost], self.tracks.track_id[lost], self.tracks.class_id[lost])
+        self.tracks.remove_deleted()
+
+        # Start new tracks, under their previous identity if the long-term memory recognizes them.
+        track_ids = np.full(len(unmatched_detections), -1, dtype=np.int64)
+        if self.memory is not None and len(unmatched_detections):
+            track_ids = self.memory.query(
+                np.array([detections[k].feature for k in unmatched_detections]),
+                np.asarray(classes)[np.asarray(unmatched_detections, dtype=np.int64)])
+        for detection_idx, track_id in zip(unmatched_detections, track_ids):
+            self._initiate_track(detections[detection_idx], classes[detection_idx].item(), confidences[detection_idx].item(),
+                                 track_id)
 
     def _full_cost_metric(self, tracks, dets, track_indices, detection_indices):
         """
@@ -112,19 +154,16 @@ class Tracker:
         is more intuitive in terms of values.
         """
         # Compute First the Position-based Cost Matrix
-        pos_cost = np.empty([len(track_indices), len(detection_indices)])
-        msrs = np.asarray([dets[i].to_xyah() for i in detection_indices])
-        for row, track_idx in enumerate(track_indices):
-            pos_cost[row, :] = np.sqrt(
-                self.kf.gating_distance(
-                    tracks[track_idx].mean, tracks[track_idx].covariance, msrs, False
-                )
-            ) / self.GATING_THRESHOLD
+        pos_cost = np.sqrt(
+            linear_assignment.gating_distance_matrix(
+                self.kf, tracks, dets, track_indices, detection_indices, False
+            )
+        ) / self.GATING_THRESHOLD
         pos_gate = pos_cost > 1.0
         # Now Compute the Appearance-based Cost Matrix
         app_cost = self.metric.distance(
             np.array([dets[i].feature for i in detection_indices]),
-            np.array([tracks[i].track_id for i in track_indices]),
+            tracks.track_id[np.asarray(track_indices, dtype=np.int64)],
         )
         app_gate = app_cost > self.metric.matching_threshold
         # Now combine and threshold
@@ -137,43 +176,43 @@ class Tracker:
 
         def gated_metric(tracks, dets, track_indices, detection_indices):
             features = np.array([dets[i].feature for i in detection_indices])
-            targets = np.array([tracks[i].track_id for i in track_indices])
+            targets = tracks.track_id[np.asarray(track_indices, dtype=np.int64)]
             cost_matrix = self.metric.distance(features, targets)
-            cost_matrix = linear_assignment.gate_cost_matrix(cost_matrix, tracks, dets, track_indices, detection_indices)
+            cost_matrix = linear_assignment.gate_cost_matrix(self.kf, cost_matrix, tracks, dets, track_indices, detection_indices)
 
             return cost_matrix
 
         # Split track set into confirmed and unconfirmed tracks.
-        confirmed_tracks = [
-            i for i, t in enumerate(self.tracks) if t.is_confirmed()]
-        unconfirmed_tracks = [
-            i for i, t in enumerate(self.tracks) if not t.is_confirmed()]
+        confirmed = self.tracks.confirmed()
+        confirmed_tracks = np.flatnonzero(confirmed).tolist()
+        unconfirmed_tracks = np.flatnonzero(~confirmed).tolist()
 
         # Associate confirmed tracks using appearance features.
         matches_a, unmatched_tracks_a, unmatched_detections = \
             linear_assignment.matching_cascade(
                 gated_metric, self.metric.matching_threshold, self.max_age,
-                self.tracks, detections, confirmed_tracks)
+                self.tracks, detections, confirmed_tracks, sparse=self.sparse_matching)
 
         # Associate remaining tracks together with unconfirmed tracks using IOU.
-        iou_track_candidates = unconfirmed_tracks + [
-            k for k in unmatched_tracks_a if
-            self.tracks[k].time_since_update == 1]
-        unmatched_tracks_a = [
-            k for k in unmatched_tracks_a if
-            self.tracks[k].time_since_update != 1]
+        unmatched_tracks_a = np.asarray(unmatched_tracks_a, dtype=np.int64)
+        recent = self.tracks.time_since_update[unmatched_tracks_a] == 1
+        iou_track_candidates = unconfirmed_tracks + unmatched_tracks_a[recent].tolist()
+        unmatched_tracks_a = unmatched_tracks_a[~recent].tolist()
         matches_b, unmatched_tracks_b, unmatched_detections = \
             linear_assignment.min_cost_matching(
                 iou_matching.iou_cost, self.max_iou_distance, self.tracks,
-                detections, iou_track_candidates, unmatched_detections)
+                detections, iou_track_candidates, unmatched_detections, sparse=self.sparse_matching)
 
         matches = matches_a + matches_b
         unmatched_tracks = list(set(unmatched_tracks_a + unmatched_tracks_b))
         return matches, unmatched_tracks, unmatched_detections
 
-    def _initiate_track(self, detection, class_id, conf):
-        self.tracks.append(Track(
-            detection.to_xyah(), self._next_id, class_id, conf, self.n_init, self.max_age, self.ema_alpha,
-            detection.feature))
+    def _initiate_track(self, detection, class_id, conf, track_id=-1):
+        if track_id >= 0:  # re-identified track, confirmed again right away
+            i = self.tracks.add(detection.to_xyah(), track_id, class_id, conf, detection.feature)
+            self.tracks.state[i] = TrackState.Confirmed
+            self.metric.add(self.tracks.features[i:i + 1], self.tracks.track_id[i:i + 1])
+            return
+        self.tracks.add(detection.to_xyah(), self._next_id, class_id, conf, detection.feature)
         # print(f'ID USED -> {self._next_id}')
         self._next_id += 1
@@ -1,15 +1,20 @@
 import numpy as np
 import torch
 import sys
+import time
 import cv2
 import gdown
 import os
 from os.path import exists as file_exists, join
 import torchvision.transforms as transforms
 
+sys.path.append(join(os.path.dirname(os.path.abspath(__file__)), 'deep', 'reid'))  # torchreid imports itself as `torchreid`
+
 from strong_sort.sort.nn_matching import NearestNeighborDistanceMetric
 from strong_sort.sort.detection import Detection
 from strong_sort.sort.tracker import Tracker
+from strong_sort.sort.long_term_memory import LongTermMemory
+from strong_sort.sort import iou_matching
 from strong_sort.deep.reid_model_factory import show_downloadeable_models, get_model_url, get_model_name
 
 from strong_sort.deep.reid.torchreid.utils import FeatureExtractor
@@ -31,49 +36,74 @@ class StrongSORT(object):
                  max_age=70, n_init=3,
                  nn_budget=100,
                  mc_lambda=0.995,
-                 ema_alpha=0.9
+                 ema_alpha=0.9,
+                 max_batch=32,
+                 sparse_matching=False,
+                 ltm_capacity=0,
+                 ltm_ttl=900,
+                 ltm_max_dist=0.15,
+                 ltm_nlist=0,
+                 ltm_nprobe=8,
+                 reid_refresh=0,
+                 reid_cache_iou=0.8,
+                 reid_ambiguous_iou=0.3,
+                 reid_budget=0,
+                 reid_budget_ms=0,
+                 model=None
                  ):
         
-        self.model = ReIDDetectMultiBackend(weights=model_weights, device=device, fp16=fp16)
+        # a ReIDDetectMultiBackend can be shared by the trackers of several streams
+        self.model = model if model is not None else ReIDDetectMultiBackend(
+            weights=model_weights, device=device, fp16=fp16, max_batch=max_batch)
         
         self.max_dist = max_dist
         metric = NearestNeighborDistanceMetric(
             "cosine", self.max_dist, nn_budget)
+        memory = LongTermMemory(
+            ltm_max_dist, ltm_ttl, ltm_capacity, ltm_nlist, ltm_nprobe) if ltm_capacity > 0 else None
         self.tracker = Tracker(
-            metric, max_iou_distance=max_iou_distance, max_age=max_age, n_init=n_init)
+            metric, max_iou_distance=max_iou_distance, max_age=max_age, n_init=n_init,
+            sparse_matching=sparse_matching, memory=memory)
+        self.reid_refresh = reid_refresh
+        self.reid_cache_iou = reid_cache_iou
+        self.reid_ambiguous_iou = reid_ambiguous_iou
+        self.reid_budget = reid_budget
+        self.reid_budget_ms = reid_budget_ms
+        # crops run through the ReID model / features reused from stable tracks / deferred over budget
+        self.reid_stats = {'computed': 0, 'reused': 0, 'deferred': 0}
         print(n_init)
 
     def update(self, bbox_xywh, confidences, classes, ori_img):
         self.height, self.width = ori_img.shape[:2]
-        # generate detections
-        features = self._get_features(bbox_xywh, ori_img)
+        self.tracker.predict()
+
+        # generate detections, the ReID model only runs on the crops that do not continue a stable track
         bbox_tlwh = self._xywh_to_tlwh(bbox_xywh)
-        detections = [Detection(bbox_tlwh[i], conf, features[i]) for i, conf in enumerate(
+        reuse, track_idx, order = self._plan_features(bbox_tlwh, classes)
+        features = [None] * len(bbox_xywh)
+        computed = self._extract_features(bbox_xywh, ori_img, order, track_idx, features)
+        deferred = order[computed:]  # over budget, they keep the feature of their track for now
+        reuse[deferred] = True
+        for i in np.flatnonzero(reuse):
+            features[i] = torch.from_numpy(self.tracker.tracks.features[track_idx[i]].copy())  # the store compacts rows in place
+        self.reid_stats['computed'] += computed
+        self.reid_stats['deferred'] += len(deferred)
+        self.reid_stats['reused'] += len(bbox_xywh) - computed - len(deferred)
+        detections = [Detection(bbox_tlwh[i], conf, features[i], reuse[i]) for i, conf in enumerate(
             confidences)]
 
-        # run on non-maximum supression
-        boxes = np.array([d.tlwh for d in detections])
-        scores = np.array([d.confidence for d in detections])
-
         # update tracker
-        self.tracker.predict()
         self.tracker.update(detections, classes, confidences)
 
-        # output bbox identities
-        outputs = []
-        for track in self.tracker.tracks:
-            if not track.is_confirmed() or track.time_since_update > 1:
-                continue
-
-            box = track.to_tlwh()
-            x1, y1, x2, y2 = self._tlwh_to_xyxy(box)
-            
-            track_id = track.track_id
-            class_id = track.class_id
-            conf = track.conf
-            outputs.append(np.array([x1, y1, x2, y2, track_id, class_id, conf]))
-        if len(outputs) > 0:
-            outputs = np.stack(outputs, axis=0)
+        # output bbox identities, (N, 7) array of x1, y1, x2, y2, track_id, class_id, conf
+        tracks = self.tracker.tracks
+        visible = tracks.confirmed() & (tracks.time_since_update <= 1)
+        x, y, w, h = tracks.to_tlwh(np.flatnonzero(visible)).T
+        # same integer truncation and clipping as _tlwh_to_xyxy
+        outputs = np.stack([
+            np.maximum(np.trunc(x), 0), np.maximum(np.trunc(y), 0),
+            np.minimum(np.trunc(x + w), self.width - 1), np.minimum(np.trunc(y + h), self.height - 1),
+            tracks.track_id[visible], tracks.class_id[visible], tracks.conf[visible]], axis=1)
         return outputs
 
     """
@@ -112,6 +142,75 @@ class StrongSORT(object):
         y2 = min(int(y+h), self.height - 1)
         return x1, y1, x2, y2
 
+    def _plan_features(self, bbox_tlwh, classes):
+        """Decide where the feature of every detection comes from.
+
+        A detection reuses the feature of a track instead of running the ReID model when
+        the detection and a confirmed track updated in the last frame overlap with an IoU
+        of at least `reid_cache_iou`, neither overlaps anything else by more than
+        `reid_ambiguous_iou`, both have the same class and the feature of the track was
+        extracted less than `reid_refresh` frames ago.
+
+        The other detections are ranked for extraction under the per-frame budget:
+        new detections (no track of the same class overlaps them by more than
+        `reid_ambiguous_iou`) first, then ambiguous ones (several tracks or detections
+        overlap), then the clear continuations of a track, the stalest track features first.
+
+        Returns
+        -------
+        (ndarray, ndarray, ndarray)
+            The reuse mask of the detections, the position of the track every detection
+            can take its feature from (-1 for new detections) and the detections to
+            extract, in order of priority.
+        """
+        reuse = np.zeros(len(bbox_tlwh), dtype=bool)
+        track_idx = np.full(len(bbox_tlwh), -1, dtype=np.int64)
+        tracks = self.tracker.tracks
+        if len(bbox_tlwh) == 0 or len(tracks) == 0 or (
+                self.reid_refresh <= 0 and self.reid_budget <= 0 and self.reid_budget_ms <= 0):
+            return reuse, track_idx, np.arange(len(bbox_tlwh))
+
+        iou = iou_matching.iou_matrix(tracks.to_tlwh(), np.asarray(bbox_tlwh, dtype=np.float64))
+        overlap = iou > self.reid_ambiguous_iou
+        same_class = tracks.class_id[:, None] == np.asarray(classes, dtype=np.int64)[None, :]
+        candidates = np.where(overlap & same_class & ~tracks.deleted()[:, None], iou, 0)
+        track_idx = np.where(candidates.max(axis=0) > 0, np.argmax(candidates, axis=0), -1)
+
+        if self.reid_refresh > 0:
+            stable = (tracks.confirmed() & (tracks.time_since_update == 1) &
+                      (tracks.feature_age < self.reid_refresh) & (overlap.sum(axis=1) == 1))
+            pairs = stable[:, None] & (iou >= self.reid_cache_iou) & (overlap.sum(axis=0) == 1)[None, :]
+            reuse[np.nonzero(pairs & same_class)[1]] = True  # at most one pair per row and per column
+
+        extract = np.flatnonzero(~reuse)
+        owner = track_idx[extract]
+        ambiguous = (overlap.sum(axis=0)[extract] > 1) | (overlap.sum(axis=1)[owner] > 1)
+        priority = np.where(owner < 0, 0, np.where(ambiguous, 1, 2))
+        staleness = np.where(owner < 0, 0, tracks.feature_age[owner])
+        return reuse, track_idx, extract[np.lexsort((-staleness, priority))]
+
+    def _extract_features(self, bbox_xywh, ori_img, order, track_idx, features):
+        """Run the ReID model on the detections in `order` until the per-frame budget of
+        `reid_budget` crops or `reid_budget_ms` milliseconds is spent. New detections have
+        no other feature to fall back on and are always extracted.
+
+        The features are written into `features`, returns the number of detections of
+        `order` that were extracted.
+        """
+        n_new = int((track_idx[order] < 0).sum())  # new detections come first in order
+        n = len(order) if self.reid_budget <= 0 else max(min(len(order), self.reid_budget), n_new)
+        chunk = n if self.reid_budget_ms <= 0 else self.model.max_batch or n
+        t0 = time.time()
+        done = 0
+        while done < n:
+            if done >= n_new and self.reid_budget_ms > 0 and (time.time() - t0) * 1E3 >= self.reid_budget_ms:
+                break
+            rows = order[done:min(done + max(chunk, n_new - done), n)]
+            for i, feature in zip(rows, self._get_features(bbox_xywh[rows], ori_img).cpu()):
+                features[i] = feature
+            done += len(rows)
+        return done
+
     def increment_ages(self):
         self.tracker.increment_ages()
 
@@ -125,13 +224,14 @@ class StrongSORT(object):
         return t, l, w, h
 
     def _get_features(self, bbox_xywh, ori_img):
-        im_crops = []
-        for box in bbox_xywh:
-            x1, y1, x2, y2 = self._xywh_to_xyxy(box)
-            im = ori_img[y1:y2, x1:x2]
-            im_crops.append(im)
-        if im_crops:
-            features = self.model(im_crops)
-        else:
-            features = np.array([])
+        if len(bbox_xywh) == 0:
+            return np.array([])
+        # same integer clipping as _xywh_to_xyxy, for all boxes at once
+        x, y, w, h = torch.as_tensor(bbox_xywh).unbind(1)
+        x1 = (x - w / 2).int().clamp(min=0)
+        x2 = (x + w / 2).int().clamp(max=self.width - 1)
+        y1 = (y - h / 2).int().clamp(min=0)
+        y2 = (y + h / 2).int().clamp(max=self.height - 1)
+        boxes = torch.stack([x1, y1, x2, y2], dim=1)
+        features = self.model(ori_img, boxes)
         return features
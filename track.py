@@ -9,8 +9,8 @@ from numpy import random
 import pandas as pd
 import geopandas as gpd
 import fiona
-from geopy import distance
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from yolov7.models.experimental import attempt_load
 from yolov7.utils.datasets import LoadImages, LoadStreams
@@ -20,7 +20,12 @@ from yolov7.utils.torch_utils import select_device, time_synchronized
 from yolov7.utils.plots import plot_one_box
 from strong_sort.utils.parser import get_config
 from strong_sort.strong_sort import StrongSORT
-from complete_data.utils import complete_kml, complete_vid
+from strong_sort.reid_multibackend import ReIDDetectMultiBackend
+from complete_data.utils import complete_kml, cumulative_distance
+from complete_data.frame_store import BestFrameStore
+from complete_data.observation_log import ObservationLog
+from complete_data.results_writer import MOTWriter
+from complete_data.async_writer import AsyncVideoWriter, AsyncImageWriter
 
 import warnings
 
@@ -51,6 +56,40 @@ ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 VID_FORMATS = ('asf', 'avi', 'gif', 'm4v', 'mkv', 'mov', 'mp4', 'mpeg', 'mpg', 'ts', 'wmv')  # include video suffixes
 
 
+def load_gps_track(kml_path, frames, interpolate=False, distance_mode='exact'):
+    # Completed KML track with one point per frame and the cumulative 3D distance traveled up to each point
+    gpd.io.file.fiona.drvsupport.supported_drivers['KML'] = 'rw'
+    geopd_df = gpd.read_file(kml_path, driver='KML')
+    geo_df = pd.DataFrame(geopd_df)
+
+    # Extract latitude and longitude from the KML geometry column
+    geo_df['Latitude'] = geo_df.geometry.apply(lambda p: p.y)
+    geo_df['Longitude'] = geo_df.geometry.apply(lambda p: p.x)
+    geo_df['Altitude'] = geo_df.geometry.apply(lambda p: p.z)
+
+    # Create the completed DF of the KML file
+    complete_df = complete_kml(geo_df, frames, interpolate=interpolate)
+
+    # Creación de distancias, distancia 3D acumulada hasta cada frame
+    dist_rec = cumulative_distance(complete_df, mode=distance_mode)
+    return complete_df, dist_rec
+
+
+def batch_frames(dataset, batch_size):
+    # Group consecutive (path, im, im0s, vid_cap) tuples with the same input shape in lists of at most batch_size.
+    # A batch can span two videos and the loader releases the capture of a video once the next one starts, so
+    # the fps is read and appended to every tuple as soon as the frame is produced
+    batch = []
+    for path, im, im0s, vid_cap in dataset:
+        fps = vid_cap.get(cv2.CAP_PROP_FPS) if vid_cap else 30  # 30 for streams
+        if batch and (len(batch) == batch_size or im.shape != batch[0][1].shape):
+            yield batch
+            batch = []
+        batch.append((path, im, im0s, vid_cap, fps))
+    if batch:
+        yield batch
+
+
 @torch.no_grad()
 def run(
         source='0',
@@ -65,6 +104,7 @@ def run(
         show_vid=True,  # show results
         save_txt=False,  # save results to *.txt
         save_conf=False,  # save confidences in --save-txt labels
+        save_npz=False,  # save --save-txt results as columnar .npz instead of text
         save_crop=False,  # save cropped prediction boxes
         save_vid=True,  # save confidences in --save-txt labels
         nosave=False,  # do not save images/videos
@@ -82,8 +122,16 @@ def run(
         hide_class=False,  # hide IDs
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
-        kml_path='demo.kml',  # Archivo kml a analizar
+        kml_path='demo.kml',  # Archivo kml a analizar, o uno por stream
         square_img_size= 1280,
+        max_cached_frames=64,  # best frames kept in RAM, the rest are spilled to disk
+        interpolate_kml=False,  # interpolate missing KML points linearly instead of repeating the last one
+        distance_mode='exact',  # geodesic used for the traveled distance: exact or haversine
+        prefetch=4,  # frames decoded ahead of inference on background threads, 0 to decode in the loop
+        batch_size=1,  # consecutive frames of a file run through YOLO as one batch, streams always use 1
+        nms_topk=None,  # most confident candidates per image kept before NMS, None to keep all
+        stream_policy='latest',  # frames delivered from streams: all, latest or fps
+        stream_fps=None,  # max frames per second decoded from every stream with the fps policy
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -94,7 +142,8 @@ def run(
         source = check_file(source)  # download
 
     # Directories
-    name_path = os.path.basename(kml_path).split('.')[0]
+    kml_paths = list(kml_path) if isinstance(kml_path, (list, tuple)) else [kml_path]
+    name_path = os.path.basename(kml_paths[0]).split('.')[0]
     project = project / name_path
 
     if not isinstance(yolo_weights, list):  # single yolo model
@@ -108,7 +157,7 @@ def run(
     exp_name = name if name else exp_name + "_" + strong_sort_weights.stem
     save_dir = increment_path(Path(project) / exp_name, exist_ok=exist_ok)  # increment run
     save_dir = Path(save_dir)
-    (save_dir / 'tracks' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
+    save_dir.mkdir(parents=True, exist_ok=True)  # make dir
 
     # Load model
     device = select_device(device)
@@ -118,25 +167,31 @@ def run(
     stride = model.stride.max()  # model stride
     imgsz = check_img_size(imgsz[0], s=stride.cpu().numpy())  # check image size
 
-    # Check Video
-    del_vid_path = complete_vid(source, save_dir, square_img_size)
-
-    # Dataloader
+    # Dataloader, frames are resized to square_img_size as they are decoded
     if webcam:
         show_vid = check_imshow()
         cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(del_vid_path, img_size=imgsz, stride=stride.cpu().numpy())
-        nr_sources = 1
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride.cpu().numpy(), policy=stream_policy,
+                              target_fps=stream_fps)
+        nr_sources = len(dataset.sources)
     else:
-        dataset = LoadImages(del_vid_path, img_size=imgsz, stride=stride)
+        dataset = LoadImages(source, img_size=imgsz, stride=stride, square_size=square_img_size, prefetch=prefetch)
         nr_sources = 1
-    vid_path, vid_writer, txt_path = [None] * nr_sources, [None] * nr_sources, [None] * nr_sources
+    txt_path = [None] * nr_sources
+
+    # Results of every stream go to their own folder when tracking several sources
+    stream_dirs = [save_dir / f'stream_{i}' for i in range(nr_sources)] if nr_sources > 1 else [save_dir]
+    for stream_dir in stream_dirs:
+        (stream_dir / 'tracks' if save_txt else stream_dir).mkdir(parents=True, exist_ok=True)
 
     # initialize StrongSORT
     cfg = get_config()
     cfg.merge_from_file(config_strongsort)
 
-    # Create as many strong sort instances as there are video sources
+    # Create as many strong sort instances as there are video sources, all sharing one ReID model
+    reid_model = ReIDDetectMultiBackend(weights=strong_sort_weights, device=device, fp16=half,
+                                        max_batch=cfg.STRONGSORT.REID_MAX_BATCH)
+    reid_model.warmup()
     strongsort_list = []
     for i in range(nr_sources):
         strongsort_list.append(
@@ -151,43 +206,64 @@ def run(
                 nn_budget=cfg.STRONGSORT.NN_BUDGET,
                 mc_lambda=cfg.STRONGSORT.MC_LAMBDA,
                 ema_alpha=cfg.STRONGSORT.EMA_ALPHA,
-
+                max_batch=cfg.STRONGSORT.REID_MAX_BATCH,
+                sparse_matching=cfg.STRONGSORT.SPARSE_MATCHING,
+                ltm_capacity=cfg.STRONGSORT.LTM_CAPACITY,
+                ltm_ttl=cfg.STRONGSORT.LTM_TTL,
+                ltm_max_dist=cfg.STRONGSORT.LTM_MAX_DIST,
+                ltm_nlist=cfg.STRONGSORT.LTM_NLIST,
+                ltm_nprobe=cfg.STRONGSORT.LTM_NPROBE,
+                reid_refresh=cfg.STRONGSORT.REID_REFRESH,
+                reid_cache_iou=cfg.STRONGSORT.REID_CACHE_IOU,
+                reid_ambiguous_iou=cfg.STRONGSORT.REID_AMBIGUOUS_IOU,
+                reid_budget=cfg.STRONGSORT.REID_BUDGET,
+                reid_budget_ms=cfg.STRONGSORT.REID_BUDGET_MS,
+                model=reid_model,
             )
         )
-        strongsort_list[i].model.warmup()
 
     outputs = [None] * nr_sources
 
     colors = [[random.randint(0, 255) for _ in range(3)] for _ in names]
 
-    # initiate KML file reading
-    gpd.io.file.fiona.drvsupport.supported_drivers['KML'] = 'rw'
-    geopd_df = gpd.read_file(kml_path, driver='KML')
-    geo_df = pd.DataFrame(geopd_df)
-
-    # Extract latitude and longitude from the KML geometry column
-    geo_df['Latitude'] = geo_df.geometry.apply(lambda p: p.y)
-    geo_df['Longitude'] = geo_df.geometry.apply(lambda p: p.x)
-    geo_df['Altitude'] = geo_df.geometry.apply(lambda p: p.z)
-
-    # Create the completed DF of the KML file
-    complete_df = complete_kml(geo_df, dataset.nframes)
-
-    # Creación de distancias
-    dist_rec = []
-    past_lat = complete_df.Latitude[0]
-    past_long = complete_df.Longitude[0]
-    past_alt = complete_df.Altitude[0]
-    past_point = [past_lat, past_long, past_alt]
-    past_dist = 0
-
-    # Create dictionaries to retrieve info based on item IDs
-
-    dict_frame = {}
-    dict_class = {}
-    dict_confidence = {}
-    dict_imgs = {}
-    dict_plots = {}
+    # GPS track of every stream, a single KML is shared by all the streams (cameras of the same vehicle)
+    assert len(kml_paths) in (1, nr_sources), f'{len(kml_paths)} KML files for {nr_sources} sources'
+    nframes = getattr(dataset, 'nframes', 0)  # unknown for streams
+    gps_tracks = [load_gps_track(kml, nframes, interpolate_kml, distance_mode) for kml in kml_paths]
+    gps_tracks *= nr_sources // len(gps_tracks)
+
+    # Boxes are drawn and videos encoded on a background thread, unless the main thread needs the annotated frame
+    draw_async = save_vid and not (show_vid or save_crop)
+    video_writer = AsyncVideoWriter() if save_vid else None
+
+    # Buffered MOT results writer, one open file per source
+    mot_writer = MOTWriter(binary=save_npz) if save_txt else None
+
+    # Columnar log of frame, ID, class, confidence and bbox of every tracked object, per stream
+    obs_logs = [ObservationLog() for _ in range(nr_sources)]
+    frame_stores = [BestFrameStore(max_in_memory=max_cached_frames, cache_dir=stream_dir / 'frame_cache')
+                    for stream_dir in stream_dirs]
+
+    # The trackers of the different streams are independent and updated in parallel
+    tracker_pool = ThreadPoolExecutor(max_workers=nr_sources) if nr_sources > 1 else None
+    map_sources = tracker_pool.map if tracker_pool is not None else map
+
+    @torch.no_grad()  # grad mode is per thread, the decorator of run does not cover the tracker pool
+    def update_tracker(i, det, im0):
+        # Camera motion compensation and StrongSORT update of source i, returns the tracks and the update time
+        if cfg.STRONGSORT.ECC:  # camera motion compensation
+            strongsort_list[i].tracker.camera_update(prev_frames[i], im0)
+        if det is None or not len(det):
+            strongsort_list[i].increment_ages()
+            return None, 0.0
+
+        # Rescale boxes from img_size to im0 size
+        det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
+
+        # pass detections to strongsort
+        t4 = time_synchronized()
+        tracks = strongsort_list[i].update(xyxy2xywh(det[:, 0:4]).cpu(), det[:, 4].cpu(), det[:, 5].cpu(), im0)
+        return tracks, time_synchronized() - t4
 
     # Run tracking
     dt, seen = [0.0, 0.0, 0.0, 0.0], 0  # Diferencia temporal en etapas y elementos vistos por img
@@ -197,11 +273,12 @@ def run(
     # im -> frame reshaped a 3,640,640
     # im0s -> frame original 3,1280,1280
     # vid_cap -> no idea
-    for frame_idx, (path, im, im0s, vid_cap) in enumerate(dataset):
+    # Offline files are processed in batches of frames, streams one frame of every source at a time
+    frame_idx = -1
+    for batch in batch_frames(dataset, 1 if webcam else batch_size):
 
-        dict_imgs.setdefault(frame_idx + 1, im0s.copy())  #
-        s = ''
         t1 = time_synchronized()
+        im = np.stack([item[1] for item in batch]) if len(batch) > 1 else batch[0][1]
         im = torch.from_numpy(im).to(device)
         im = im.half() if half else im.float()  # uint8 to fp16/32
         im /= 255.0  # 0 - 255 to 0.0 - 1.0
@@ -212,7 +289,7 @@ def run(
         dt[0] += t2 - t1
 
         # Inference
-        visualize = increment_path(save_dir / Path(path[0]).stem, mkdir=True) if visualize else False
+        visualize = increment_path(save_dir / Path(batch[0][0][0]).stem, mkdir=True) if visualize else False
         pred = model(im)
         # pred[0].shape[2]-5 -> n° classes
 
@@ -220,205 +297,200 @@ def run(
         dt[1] += t3 - t2
 
         # Apply NMS
-        pred = non_max_suppression(pred[0], conf_thres, iou_thres, classes, agnostic_nms)
+        pred = non_max_suppression(pred[0], conf_thres, iou_thres, classes, agnostic_nms, topk=nms_topk)
         dt[2] += time_synchronized() - t3
 
-        # Process detections
-        for i, det in enumerate(pred):  # detections per image
-
-            seen += 1
-            if webcam:  # nr_sources >= 1
-                p, im0, _ = path[i], im0s[i].copy(), dataset.count
-                p = Path(p)  # to Path
-                s += f'{i}: '
-                txt_file_name = p.name
-                save_path = str(save_dir / source)  # im.jpg, vid.mp4, ...
-
-            else:
-                p, im0, _ = path, im0s.copy(), getattr(dataset, 'frame', 0)
-                p = Path(p)  # to Path
-                # video file
-                if source.endswith(VID_FORMATS):
-                    txt_file_name = p.stem
-                    save_path = str(save_dir / source)  # im.jpg, vid.mp4, ...
-                # folder with imgs
+        # Detections of every frame in the batch, for streams a single frame with one image per source
+        frame_preds = [pred] if webcam else [[det] for det in pred]
+
+        for (path, _, im0s, vid_cap, fps), pred in zip(batch, frame_preds):
+
+            s = ''
+            frame_idx += 1
+
+            # Clean frame of every source, tracked in parallel before drawing on them
+            frames = list(im0s) if webcam else [im0s]
+            results = list(map_sources(update_tracker, range(len(pred)), pred, frames))
+
+            # Process detections
+            for i, det in enumerate(pred):  # detections per image
+
+                seen += 1
+                if webcam:  # nr_sources >= 1
+                    p, im0, _ = path[i], im0s[i] if draw_async else im0s[i].copy(), dataset.count
+                    p = Path(p)  # to Path
+                    s += f'{i}: '
+                    txt_file_name = p.name
+                    save_path = str(stream_dirs[i] / p.name)  # im.jpg, vid.mp4, ...
+
                 else:
-                    txt_file_name = p.parent.name  # get folder name containing current img
-                    save_path = str(save_dir / source)  # im.jpg, vid.mp4, ...
-
-            curr_frames[i] = im0
-
-            txt_path = str(save_dir / 'tracks' / txt_file_name)  # im.txt
-            s += '%gx%g ' % im.shape[2:]  # print string
-            imc = im0.copy() if save_crop else im0  # for save_crop
-
-            if cfg.STRONGSORT.ECC:  # camera motion compensation
-                strongsort_list[i].tracker.camera_update(prev_frames[i], curr_frames[i])
-
-            if det is not None and len(det):
-                # Rescale boxes from img_size to im0 size
-                det_og = det[:, :4].round()
-                det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
-
-                # Print results
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s += f"{n} of {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-
-                xywhs = xyxy2xywh(det[:, 0:4])
-                confs = det[:, 4]
-                clss = det[:, 5]
-
-                # pass detections to strongsort
-                t4 = time_synchronized()
-                outputs[i] = strongsort_list[i].update(xywhs.cpu(), confs.cpu(), clss.cpu(), im0)
-                t5 = time_synchronized()
-                dt[3] += t5 - t4
-
-                # draw boxes for visualization and save info
-                if len(outputs[i]) > 0:
-                    # print([[frame_idx + 1, tracks.track_id, tracks.class_id.item(), tracks.conf.item()] for tracks in
-                    # strongsort_list[i].tracker.tracks if tracks.is_confirmed()])
-
-                    for j, (output, conf) in enumerate(zip(outputs[i], confs)):  # (output[6]==conf) No change, it works
-
-                        bboxes_og = det[j,0:4]
-                        bboxes = output[0:4]
-                        id = int(output[4])
-                        cls = int(output[5])
-                        conf = round(conf.item(), 2)
-
-                        # Get info into the dictionaries
-
-                        dict_frame.setdefault(str(id), [])  # frames
-                        dict_frame[str(id)].append(frame_idx + 1)
-
-                        dict_class.setdefault(str(id), names[cls])  # classes
-
-                        dict_confidence.setdefault(str(id), [])  # confidence
-                        dict_confidence[str(id)].append(conf)
-
-                        dict_plots.setdefault(str(id), [])  # guardado de bbox de objetos detectados
-                        dict_plots[str(id)].append(bboxes)
-
-                        if save_txt:
-                            # to MOT format
-                            bbox_left = output[0]
-                            bbox_top = output[1]
-                            bbox_w = output[2] - output[0]
-                            bbox_h = output[3] - output[1]
-                            # Write MOT compliant results to file
-                            with open(txt_path + '.txt', 'a') as f:
-                                f.write(('%g ' * 10 + '\n') % (frame_idx + 1, id, bbox_left,  # MOT format
-                                                               bbox_top, bbox_w, bbox_h, -1, -1, -1, i))
-
-                        if save_vid or save_crop or show_vid:  # Add bbox to image
-
-                            label = None if hide_labels else (f'{id} {names[cls]}' if hide_conf else \
-                                                                  (
-                                                                      f'{id} {conf:.2f}' if hide_class else f'{id} {names[cls]} {conf:.2f}'))
-
-                            plot_one_box(bboxes, im0, label=label, color=colors[int(cls)], line_thickness=2)
-
-                            # if save_crop:
-                            # txt_file_name = txt_file_name if (isinstance(path, list) and len(path) > 1) else ''
-                            # save_one_box(bboxes, imc, file=save_dir / 'crops' / txt_file_name / names[c] / f'{id}' / f'{p.stem}.jpg', BGR=True)}
-
-                print(f'{s}Done. YOLO:({t3 - t2:.3f}s), StrongSORT:({t5 - t4:.3f}s)')
-
-            else:
-                strongsort_list[i].increment_ages()
-                print('No detections')
-
-            # Stream results
-            if show_vid:
-                cv2.imshow(str(p), im0)
-                cv2.waitKey(1)  # 1 millisecond
-
-            # Save results (image with detections)
-            if save_vid:
-                if vid_path[i] != save_path:  # new video
-                    vid_path[i] = save_path
-                    if isinstance(vid_writer[i], cv2.VideoWriter):
-                        vid_writer[i].release()  # release previous video writer
-                    if vid_cap:  # video
-                        fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                        w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                        h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                    else:  # stream
-                        fps, w, h = 30, im0.shape[1], im0.shape[0]
+                    p, im0, _ = path, im0s if draw_async else im0s.copy(), getattr(dataset, 'frame', 0)
+                    p = Path(p)  # to Path
+                    # video file
+                    if source.endswith(VID_FORMATS):
+                        txt_file_name = p.stem
+                        save_path = str(save_dir / source)  # im.jpg, vid.mp4, ...
+                    # folder with imgs
+                    else:
+                        txt_file_name = p.parent.name  # get folder name containing current img
+                        save_path = str(save_dir / source)  # im.jpg, vid.mp4, ...
+
+                curr_frames[i] = frames[i]
+
+                txt_path = str(stream_dirs[i] / 'tracks' / txt_file_name)  # im.txt
+                s += '%gx%g ' % im.shape[2:]  # print string
+                imc = im0.copy() if save_crop else im0  # for save_crop
+
+                annotations = []  # (bbox, label, color) drawn by the video writer
+
+                if det is not None and len(det):
+                    # Print results
+                    for c in det[:, -1].unique():
+                        n = (det[:, -1] == c).sum()  # detections per class
+                        s += f"{n} of {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+
+                    confs = det[:, 4]
+
+                    outputs[i], t_sort = results[i]
+                    dt[3] += t_sort
+
+                    # draw boxes for visualization and save info
+                    frame_ids, frame_clss, frame_confs, frame_bboxes, mot_rows = [], [], [], [], []
+                    if len(outputs[i]) > 0:
+                        # print([[frame_idx + 1, tracks.track_id, tracks.class_id.item(), tracks.conf.item()] for tracks in
+                        # strongsort_list[i].tracker.tracks if tracks.is_confirmed()])
+
+                        for j, (output, conf) in enumerate(zip(outputs[i], confs)):  # (output[6]==conf) No change, it works
+
+                            bboxes_og = det[j,0:4]
+                            bboxes = output[0:4]
+                            id = int(output[4])
+                            cls = int(output[5])
+                            conf = round(conf.item(), 2)
+
+                            # Get info into the observation log
+                            frame_ids.append(id)
+                            frame_clss.append(cls)
+                            frame_confs.append(conf)
+                            frame_bboxes.append(bboxes)  # guardado de bbox de objetos detectados
+
+                            if save_txt:
+                                # to MOT format
+                                bbox_left = output[0]
+                                bbox_top = output[1]
+                                bbox_w = output[2] - output[0]
+                                bbox_h = output[3] - output[1]
+                                mot_rows.append((frame_idx + 1, id, bbox_left,  # MOT format
+                                                 bbox_top, bbox_w, bbox_h, -1, -1, -1, i))
+
+                            if save_vid or save_crop or show_vid:  # Add bbox to image
+
+                                label = None if hide_labels else (f'{id} {names[cls]}' if hide_conf else \
+                                                                      (
+                                                                          f'{id} {conf:.2f}' if hide_class else f'{id} {names[cls]} {conf:.2f}'))
+
+                                if draw_async:
+                                    annotations.append((bboxes, label, colors[int(cls)]))
+                                else:
+                                    plot_one_box(bboxes, im0, label=label, color=colors[int(cls)], line_thickness=2)
+
+                                # if save_crop:
+                                # txt_file_name = txt_file_name if (isinstance(path, list) and len(path) > 1) else ''
+                                # save_one_box(bboxes, imc, file=save_dir / 'crops' / txt_file_name / names[c] / f'{id}' / f'{p.stem}.jpg', BGR=True)}
+
+                    obs_logs[i].append(frame_idx + 1, frame_ids, frame_clss, frame_confs, frame_bboxes)
+                    if save_txt:  # Write MOT compliant results of the frame
+                        mot_writer.write(txt_path, mot_rows)
+
+                    # keep the clean frame only while it is the best frame of some ID
+                    frame_stores[i].update(frame_idx + 1, frames[i], frame_ids, frame_confs)
+
+                    print(f'{s}Done. YOLO:({t3 - t2:.3f}s), StrongSORT:({t_sort:.3f}s)')
+
+                else:
+                    print('No detections')
+
+                # Stream results
+                if show_vid:
+                    cv2.imshow(str(p), im0)
+                    cv2.waitKey(1)  # 1 millisecond
+
+                # Save results (image with detections), the frame is handed over by reference
+                if save_vid:
+                    w, h = im0.shape[1], im0.shape[0]  # video frames are already resized by the loader
                     save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                    vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                vid_writer[i].write(im0)
-
-            prev_frames[i] = curr_frames[i]
-
-        # Update curr location
-        curr_lat = complete_df.Latitude[frame_idx]
-        curr_long = complete_df.Longitude[frame_idx]
-        curr_alt = complete_df.Altitude[frame_idx]
-        curr_point = [curr_lat, curr_long, curr_alt]
-
-        # Calculate distance traveled
-        distance_2d = distance.distance(past_point[:2], curr_point[:2]).m
-        distance_3d = np.sqrt(distance_2d ** 2 + (past_point[2] - curr_point[2]) ** 2)
-        dist_rec.append(distance_3d + past_dist)
-
-        # Update past location
-        past_lat = complete_df.Latitude[frame_idx]
-        past_long = complete_df.Longitude[frame_idx]
-        past_alt = complete_df.Altitude[frame_idx]
-        past_dist = distance_3d + past_dist
-        past_point = [past_lat, past_long, past_alt]
-
-    # Create directory for images
-    if not os.path.isdir(save_dir / 'Imgs'):
-        # not present then create it.
-        os.makedirs(save_dir / 'Imgs')
-
-    # Create DF
-    cols = ['ID_Objeto', 'ID_Fotograma', 'Dist Met (Km)', 'Clase', 'Max seguridad', 'Min seguridad', 'Latitud',
-            'Longitud']
-    df_out = pd.DataFrame(columns=cols)  # To add a row -> df_out.loc[len(df_out)] = Row_in en formato lista
-
-    IDS = dict_class.keys()
-    for id_obj in IDS:
-        clase = dict_class[id_obj]  # clase del id_obj
-        max_conf = max(dict_confidence[id_obj])
-        min_conf = min(dict_confidence[id_obj])
-        idx_max_conf = dict_confidence[id_obj].index(max_conf)  # índice de max conf
-        id_frame = dict_frame[id_obj][idx_max_conf]  # frame con el max conf, guardado como (idx_frame + 1)
-        last_frame = dict_frame[id_obj][-1]  # última vista del objeto para Lat and Long
-        lat = complete_df.iloc[last_frame - 1].Latitude
-        long = complete_df.iloc[last_frame - 1].Longitude
-        trav_dist = round(dist_rec[last_frame - 1] / 1000, 4)
-
-        # Save info in DF
-        row_list = [int(id_obj), id_frame, trav_dist, clase, max_conf, min_conf, lat, long]
-        df_out.loc[len(df_out)] = row_list
-
-        # Save imgs
-        bb = dict_plots[id_obj][idx_max_conf]  # bounding box del obj con mayor conf
-        img_2save = dict_imgs[id_frame]  # img del frame con mayor conf
-
-        label = f'{id_obj} {clase} {max_conf:.2f}'
-
-        plot_one_box(bb, img_2save, label=label, color=[255, 0, 255], line_thickness=3)
-
-        file_name = f'{id_obj}_ID.jpg'
-        img_path = save_dir / 'Imgs' / file_name
-        cv2.imwrite(str(img_path), img_2save)
-
-    df_out.to_excel(save_dir / f'{name_path}.xlsx')
-    os.remove(del_vid_path)
+                    video_writer.write(i, save_path, fps, (w, h), im0, annotations)
+
+                prev_frames[i] = curr_frames[i]
+
+    if save_txt:
+        mot_writer.close()
+    if save_vid:
+        video_writer.close()
+    if tracker_pool is not None:
+        tracker_pool.shutdown()
+
+    # Tables and images of every stream, images are encoded and saved in parallel
+    image_writer = AsyncImageWriter()
+    for stream_dir, obs_log, frame_store, (complete_df, dist_rec) in zip(stream_dirs, obs_logs, frame_stores, gps_tracks):
+        # Create directory for images
+        if not os.path.isdir(stream_dir / 'Imgs'):
+            # not present then create it.
+            os.makedirs(stream_dir / 'Imgs')
+
+        # Create DF, one row per ID in order of first appearance
+        summary = obs_log.summary()
+        # última vista del objeto para Lat and Long, los streams pueden superar el largo del KML
+        last_idx = np.minimum(summary['last_frame'].to_numpy() - 1, len(complete_df) - 1)
+        df_out = pd.DataFrame({
+            'ID_Objeto': summary['id'],
+            'ID_Fotograma': summary['best_frame'],  # frame con el max conf, guardado como (idx_frame + 1)
+            'Dist Met (Km)': np.round(dist_rec[last_idx] / 1000, 4),
+            'Clase': np.asarray(names, dtype=object)[summary['cls'].to_numpy()],
+            'Max seguridad': summary['max_conf'],
+            'Min seguridad': summary['min_conf'],
+            'Latitud': complete_df.Latitude.to_numpy()[last_idx],
+            'Longitud': complete_df.Longitude.to_numpy()[last_idx],
+        })
+
+        for id_obj, id_frame, clase, max_conf, bb in zip(df_out['ID_Objeto'], df_out['ID_Fotograma'], df_out['Clase'],
+                                                         df_out['Max seguridad'], summary[['x1', 'y1', 'x2', 'y2']].to_numpy()):
+            # Save imgs, bb es el bounding box del obj con mayor conf
+            img_2save = frame_store.frame(id_frame)  # img del frame con mayor conf
+
+            label = f'{id_obj} {clase} {max_conf:.2f}'
+
+            plot_one_box(bb, img_2save, label=label, color=[255, 0, 255], line_thickness=3)
+
+            file_name = f'{id_obj}_ID.jpg'
+            img_path = stream_dir / 'Imgs' / file_name
+            frame_store.drop(id_obj)
+            # the frame keeps collecting boxes while other IDs still refer to it, save a snapshot
+            image_writer.imwrite(img_path, img_2save.copy() if id_frame in frame_store.refs else img_2save)
+
+        frame_store.close()
+
+        df_out.to_excel(stream_dir / f'{name_path}.xlsx')
+
+    image_writer.close()
 
     # Print results
     t = tuple(x / seen * 1E3 for x in dt)  # speeds per image
     print(
         f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS, %.1fms strong sort update per image at shape {(1, 3, imgsz, imgsz)}' % t)
     if save_txt or save_vid:
-        s = f"\n{len(list(save_dir.glob('tracks/*.txt')))} tracks saved to {save_dir / 'tracks'}" if save_txt else ''
+        n_tracks = sum(len(list(d.glob('tracks/*.npz' if save_npz else 'tracks/*.txt'))) for d in stream_dirs)
+        s = f"\n{n_tracks} tracks saved to {', '.join(str(d / 'tracks') for d in stream_dirs)}" if save_txt else ''
         print(f"Results saved to {colorstr('bold', save_dir)}{s}")
+    for i, strongsort in enumerate(strongsort_list):
+        st = strongsort.reid_stats
+        total = max(st['computed'] + st['reused'] + st['deferred'], 1)
+        print(f"{'stream %d ' % i if nr_sources > 1 else ''}ReID: {st['computed']} crops computed, "
+              f"{st['reused']} features reused from stable tracks ({st['reused'] / total:.0%}), "
+              f"{st['deferred']} deferred over the per-frame budget")
+    if webcam:
+        for st in dataset.stats():
+            print(f"{st['source']}: {st['delivered']} frames tracked, {st['skipped']} skipped, {st['failed']} failed reads")
     if update:
         strip_optimizer(yolo_weights)  # update model (to fix SourceChangeWarning)
 
@@ -437,6 +509,7 @@ def parse_opt():
     parser.add_argument('--show-vid', action='store_true', help='display tracking video results')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--save-conf', action='store_true', help='save confidences in --save-txt labels')
+    parser.add_argument('--save-npz', action='store_true', help='save --save-txt results as columnar .npz')
     parser.add_argument('--save-crop', action='store_true', help='save cropped prediction boxes')
     parser.add_argument('--save-vid', action='store_false', help='save video tracking results')
     parser.add_argument('--nosave', action='store_true', help='do not save images/videos')
@@ -455,8 +528,16 @@ def parse_opt():
     parser.add_argument('--hide-class', default=False, action='store_true', help='hide IDs')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
-    parser.add_argument('--kml-path', type=str, default='demo.kml', help='path archivo kml')
+    parser.add_argument('--kml-path', nargs='+', type=str, default='demo.kml', help='path archivo kml, uno por stream')
     parser.add_argument('--square-img-size', type=int, default=1280, help='tamaño de outputs cuadrados')
+    parser.add_argument('--interpolate-kml', action='store_true', help='interpolar linealmente los puntos kml faltantes')
+    parser.add_argument('--distance-mode', default='exact', choices=['exact', 'haversine'], help='cálculo de distancia recorrida')
+    parser.add_argument('--stream-policy', default='latest', choices=['all', 'latest', 'fps'], help='frames taken from streams')
+    parser.add_argument('--stream-fps', type=float, default=None, help='max FPS decoded per stream with --stream-policy fps')
+    parser.add_argument('--nms-topk', type=int, default=None, help='candidates per image kept before NMS')
+    parser.add_argument('--batch-size', type=int, default=1, help='frames per YOLO batch for video files')
+    parser.add_argument('--prefetch', type=int, default=4, help='frames decoded ahead of inference, 0 to disable')
+    parser.add_argument('--max-cached-frames', type=int, default=64, help='best frames kept in RAM before spilling to disk')
 
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
@@ -6,10 +6,12 @@ import os
 import random
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import repeat
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from threading import Thread
+from queue import Queue
+from threading import Event, Thread
 
 import cv2
 import numpy as np
@@ -21,7 +23,7 @@ from tqdm import tqdm
 import os
 
 import pickle
-from copy import deepcopy
+from copy import copy, deepcopy
 
 # from pycocotools import mask as maskUtils
 from torchvision.utils import save_image
@@ -127,7 +129,7 @@ class _RepeatSampler(object):
 
 
 class LoadImages:  # for inference
-    def __init__(self, path, img_size=640, stride=32):
+    def __init__(self, path, img_size=640, stride=32, square_size=None, prefetch=0, workers=2):
         p = str(Path(path).absolute())  # os-agnostic absolute path
         if '*' in p:
             files = sorted(glob.glob(p, recursive=True))  # glob
@@ -144,10 +146,14 @@ class LoadImages:  # for inference
 
         self.img_size = img_size
         self.stride = stride
+        self.square_size = square_size  # resize every frame to square_size x square_size as it is read
+        self.prefetch = prefetch  # frames decoded ahead on background threads, 0 to decode synchronously
+        self.workers = workers  # threads running resize + letterbox when prefetching
         self.files = images + videos
         self.nf = ni + nv  # number of files
         self.video_flag = [False] * ni + [True] * nv
         self.mode = 'image'
+        self.frame = self.nframes = 0  # queued by the prefetch reader for images too
         if any(videos):
             self.new_video(videos[0])  # new video
         else:
@@ -157,9 +163,38 @@ class LoadImages:  # for inference
 
     def __iter__(self):
         self.count = 0
+        if self.prefetch:
+            # a copy of the loader reads ahead, self keeps the state of the frame last returned
+            reader = copy(self)
+            self.queue = Queue(maxsize=self.prefetch)
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            self.thread = Thread(target=self._prefetch, args=(reader,), daemon=True)
+            self.thread.start()
         return self
 
     def __next__(self):
+        if self.prefetch:
+            item = self.queue.get()
+            if item is None:
+                self._release(None)
+                raise StopIteration
+            if isinstance(item, Exception):
+                raise item
+            future, path, cap, self.count, self.frame, self.nframes, self.mode = item
+            self._release(cap)  # previous video is done
+            self.cap = cap
+            img, img0 = future.result()
+        else:
+            path, img0 = self._read()
+            img, img0 = self._transform(img0)
+
+        if self.mode == 'video':
+            print(f'video frames ({self.frame}/{self.nframes}): ', end='')
+
+        return path, img, img0, self.cap
+
+    def _read(self, release=True):
+        # Read the next raw frame in file order
         if self.count == self.nf:
             raise StopIteration
         path = self.files[self.count]
@@ -170,7 +205,8 @@ class LoadImages:  # for inference
             ret_val, img0 = self.cap.read()
             if not ret_val:
                 self.count += 1
-                self.cap.release()
+                if release:
+                    self.cap.release()
                 if self.count == self.nf:  # last video
                     raise StopIteration
                 else:
@@ -179,7 +215,6 @@ class LoadImages:  # for inference
                     ret_val, img0 = self.cap.read()
 
             self.frame += 1
-            print(f'video frames ({self.frame}/{self.nframes}): ', end='')
 
         else:
             # Read image
@@ -188,6 +223,12 @@ class LoadImages:  # for inference
             assert img0 is not None, 'Image Not Found ' + path
             #print(f'image {self.count}/{self.nf} {path}: ', end='')
 
+        return path, img0
+
+    def _transform(self, img0):
+        if self.square_size is not None:
+            img0 = square_resize(img0, self.square_size)
+
         # Padded resize
         img = letterbox(img0, self.img_size, stride=self.stride)[0]
 
@@ -195,7 +236,27 @@ class LoadImages:  # for inference
         img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
         img = np.ascontiguousarray(img)
 
-        return path, img, img0, self.cap
+        return img, img0
+
+    def _prefetch(self, reader):
+        # Decode frames in order, resize and letterbox them on the pool. The bounded queue keeps
+        # the futures in frame order and stops the reader `prefetch` frames ahead of the consumer
+        try:
+            while True:
+                try:
+                    path, img0 = reader._read(release=False)  # caps are released by the consumer
+                except StopIteration:
+                    break
+                future = self.pool.submit(reader._transform, img0)
+                self.queue.put((future, path, reader.cap, reader.count, reader.frame, reader.nframes, reader.mode))
+        except Exception as e:
+            self.queue.put(e)
+        self.queue.put(None)
+        self.pool.shutdown(wait=False)
+
+    def _release(self, cap):
+        if self.cap is not None and self.cap is not cap:
+            self.cap.release()
 
     def new_video(self, path):
         self.frame = 0
@@ -265,10 +326,23 @@ class LoadWebcam:  # for inference
 
 
 class LoadStreams:  # multiple IP or RTSP cameras
-    def __init__(self, sources='streams.txt', img_size=640, stride=32):
+    """
+    Reads every source on its own thread. Frame skipping follows `policy`:
+        'all'     every frame is delivered, the reader blocks when `buffer` frames are pending
+        'latest'  each source keeps only its newest frame, older undelivered frames are skipped
+        'fps'     like 'latest' but frames are decoded at most `target_fps` times per second
+    The newest frame of a source lives in a single slot replaced as a whole (frame, timestamp, seq),
+    timestamps are time.monotonic() at capture. Failed reads are counted and never delivered.
+    """
+
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, policy='latest', target_fps=None, buffer=8):
+        assert policy in ('all', 'latest', 'fps'), f'Unknown stream policy {policy}'
+        assert policy != 'fps' or target_fps, 'target_fps is required for the fps policy'
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
+        self.policy = policy
+        self.target_fps = target_fps
 
         if os.path.isfile(sources):
             with open(sources, 'r') as f:
@@ -279,6 +353,14 @@ class LoadStreams:  # multiple IP or RTSP cameras
         n = len(sources)
         self.imgs = [None] * n
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
+        self.fps = [0.0] * n
+        self.slots = [None] * n  # newest (frame, timestamp, seq) of every source
+        self.queues = [Queue(maxsize=buffer) for _ in range(n)] if policy == 'all' else None
+        self.events = [Event() for _ in range(n)]  # set when a source has an undelivered frame
+        self.timestamps = [0.0] * n  # capture times of the frames returned by the last __next__
+        self.last_seq = [0] * n  # seq of the frames returned by the last __next__
+        self.captured, self.skipped, self.delivered, self.failed = [0] * n, [0] * n, [0] * n, [0] * n  # telemetry
+        self.alive = [True] * n
         for i, s in enumerate(sources):
             # Start the thread to read frames from the video stream
             print(f'{i + 1}/{n}: {s}... ', end='')
@@ -291,11 +373,13 @@ class LoadStreams:  # multiple IP or RTSP cameras
             assert cap.isOpened(), f'Failed to open {s}'
             w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            self.fps = cap.get(cv2.CAP_PROP_FPS) % 100
+            self.fps[i] = cap.get(cv2.CAP_PROP_FPS) % 100 or 30  # 30 FPS fallback
 
-            _, self.imgs[i] = cap.read()  # guarantee first frame
+            success, self.imgs[i] = cap.read()  # guarantee first frame
+            assert success, f'Failed to read {s}'
+            self._publish(i, self.imgs[i], time.monotonic(), 1)
             thread = Thread(target=self.update, args=([i, cap]), daemon=True)
-            print(f' success ({w}x{h} at {self.fps:.2f} FPS).')
+            print(f' success ({w}x{h} at {self.fps[i]:.2f} FPS).')
             thread.start()
         print('')  # newline
 
@@ -305,18 +389,63 @@ class LoadStreams:  # multiple IP or RTSP cameras
         if not self.rect:
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
 
-    def update(self, index, cap):
-        # Read next stream frame in a daemon thread
-        n = 0
-        while cap.isOpened():
-            n += 1
-            # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n == 4:  # read every 4th frame
+    def update(self, index, cap, max_failures=300):
+        # Read next stream frame in a daemon thread, the stream ends after max_failures failed reads in a row
+        seq, failures = 1, 0
+        period = 1 / self.target_fps if self.policy == 'fps' else 0  # min time between decoded frames
+        next_decode = last_read = time.monotonic()
+        while cap.isOpened() and failures < max_failures:
+            wait = last_read + 1 / self.fps[index] - time.monotonic()
+            if wait > 0:  # do not read faster than the source, e.g. video files
+                time.sleep(wait)
+            last_read = time.monotonic()
+            success = cap.grab()
+            timestamp = time.monotonic()
+            if success:
+                self.captured[index] += 1
+                if timestamp < next_decode:  # 'fps' policy, dropped without decoding
+                    self.skipped[index] += 1
+                    continue
+                next_decode = max(next_decode, timestamp - period) + period
                 success, im = cap.retrieve()
-                self.imgs[index] = im if success else self.imgs[index] * 0
-                n = 0
-            time.sleep(1 / self.fps)  # wait time
+            if not success:
+                failures += 1
+                self.failed[index] += 1
+                continue
+            failures = 0
+            seq += 1
+            self._publish(index, im, timestamp, seq)
+        cap.release()
+        self.alive[index] = False
+        self.events[index].set()  # wake up the consumer
+
+    def _publish(self, index, im, timestamp, seq):
+        if self.queues is not None:
+            self.queues[index].put((im, timestamp, seq))  # blocks while the buffer is full
+        else:
+            prev = self.slots[index]
+            if prev is not None and prev[2] > self.last_seq[index]:  # never delivered
+                self.skipped[index] += 1
+            self.slots[index] = (im, timestamp, seq)  # replaced as a whole, no lock needed
+        self.events[index].set()
+
+    def _take(self, index):
+        # Next frame of a source, waits for one newer than the last delivered
+        while True:
+            self.events[index].clear()
+            if self.queues is not None and not self.queues[index].empty():
+                return self.queues[index].get()
+            slot = self.slots[index]
+            if self.queues is None and slot[2] > self.last_seq[index]:
+                return slot
+            if not self.alive[index]:
+                raise StopIteration
+            self.events[index].wait(timeout=1.0)
+
+    def stats(self):
+        # Per source telemetry: frames captured, skipped without being delivered, delivered and failed reads
+        return [{'source': s, 'captured': c, 'skipped': k, 'delivered': d, 'failed': f}
+                for s, c, k, d, f in zip(self.sources, self.captured, self.skipped, self.delivered, self.failed)]
 
     def __iter__(self):
         self.count = -1
@@ -324,11 +453,16 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
     def __next__(self):
         self.count += 1
-        img0 = self.imgs.copy()
         if cv2.waitKey(1) == ord('q'):  # q to quit
             cv2.destroyAllWindows()
             raise StopIteration
 
+        img0 = []
+        for i in range(len(self.sources)):
+            im, self.timestamps[i], self.last_seq[i] = self._take(i)
+            self.delivered[i] += 1
+            img0.append(im)
+
         # Letterbox
         img = [letterbox(x, self.img_size, auto=self.rect, stride=self.stride)[0] for x in img0]
 
@@ -982,6 +1116,13 @@ def replicate(img, labels):
     return img, labels
 
 
+def square_resize(img, size):
+    # Resize image to size x size, using area interpolation when downsampling
+    h, w = img.shape[:2]
+    interpolation = cv2.INTER_AREA if w * h > size * size else cv2.INTER_LINEAR
+    return cv2.resize(img, (size, size), interpolation=interpolation)
+
+
 def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
     # Resize and pad image while meeting stride-multiple constraints
     shape = img.shape[:2]  # current shape [height, width]
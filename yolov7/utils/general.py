@@ -605,98 +605,126 @@ def box_diou(box1, box2, eps: float = 1e-7):
 
 
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=()):
+                        labels=(), topk=None):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
+    All images of the batch are filtered at once and, on CUDA, go through a single NMS call with boxes
+    offset by image index and class.
+    topk keeps only the topk most confident candidates of every image before NMS.
+
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
 
+    bs = prediction.shape[0]  # batch size
     nc = prediction.shape[2] - 5  # number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
 
     # Settings
     min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
     max_det = 300  # maximum number of detections per image
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 10.0  # seconds to quit after
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
     merge = False  # use merge-NMS
-
-    t = time.time()
-    output = [torch.zeros((0, 6), device=prediction.device)] * prediction.shape[0]
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[xc[xi]]  # confidence
-
-        # Cat apriori labels if autolabelling
-        if labels and len(labels[xi]):
-            l = labels[xi]
-            v = torch.zeros((len(l), nc + 5), device=x.device)
-            v[:, :4] = l[:, 1:5]  # box
-            v[:, 4] = 1.0  # conf
-            v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
-            x = torch.cat((x, v), 0)
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        if nc == 1:
-            x[:, 5:] = x[:, 4:5] # for models with one class, cls_loss is 0 and cls_conf is always 0.5,
-                                 # so there is no need to multiplicate.
-        else:
-            x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
-        else:  # best class only
-            conf, j = x[:, 5:].max(1, keepdim=True)
-            x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
-
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
-
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
-
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
-
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
-
-        output[xi] = x[i]
-        if (time.time() - t) > time_limit:
-            print(f'WARNING: NMS time limit {time_limit}s exceeded')
-            break  # time limit exceeded
-
-    return output
+    max_cand = min(max_nms, topk) if topk else max_nms
+
+    # Apply constraints
+    # prediction[((prediction[..., 2:4] < min_wh) | (prediction[..., 2:4] > max_wh)).any(-1), 4] = 0  # width-height
+    b, _ = xc.nonzero(as_tuple=True)  # image index of every candidate
+    x = prediction[xc]  # confidence
+
+    # Cat apriori labels if autolabelling
+    if labels and sum(len(l) for l in labels):
+        l = torch.cat([l for l in labels if len(l)])
+        v = torch.zeros((len(l), nc + 5), device=x.device)
+        v[:, :4] = l[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
+        lb = torch.cat([torch.full((len(l),), xi, device=x.device) for xi, l in enumerate(labels) if len(l)])
+        b = torch.cat((b, lb))
+        order = (b * len(b) + torch.arange(len(b), device=b.device)).argsort()  # labels after the predictions of their image
+        x, b = torch.cat((x, v.to(x.dtype)))[order], b[order]
+
+    output = [torch.zeros((0, 6), device=prediction.device)] * bs
+    # If none remain return empty detections
+    if not x.shape[0]:
+        return output
+
+    # Compute conf
+    if nc == 1:
+        x[:, 5:] = x[:, 4:5] # for models with one class, cls_loss is 0 and cls_conf is always 0.5,
+                             # so there is no need to multiplicate.
+    else:
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, b = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float()), 1)[keep], b[keep]
+
+    # Filter by class
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[keep], b[keep]
+
+    # Apply finite constraint
+    # if not torch.isfinite(x).all():
+    #     keep = torch.isfinite(x).all(1)
+    #     x, b = x[keep], b[keep]
+
+    # Check shape
+    n = x.shape[0]  # number of boxes
+    if not n:  # no boxes
+        return output
+    elif torch.bincount(b, minlength=bs).max() > max_cand:  # excess boxes, keep the most confident of every image
+        order = _by_image_and_score(b, x[:, 4])
+        x, b = x[order], b[order]
+        keep = _rank_in_group(b, bs) < max_cand
+        x, b = x[keep], b[keep]
+        n = x.shape[0]
+
+    # Batched NMS, boxes of different images and classes never overlap once offset
+    group = b * (1 if agnostic else nc) + (0 if agnostic else x[:, 5].long())
+    boxes = x[:, :4].double() + group[:, None].double() * max_wh  # float64 keeps the offset boxes exact
+    scores = x[:, 4]
+    if boxes.is_cuda:  # one NMS kernel for the whole batch
+        i = torchvision.ops.nms(boxes, scores.double(), iou_thres)  # NMS, sorted by decreasing score
+        i = i[_by_image_and_score(b[i], scores[i])]
+    else:  # the CPU kernel is quadratic in the number of boxes, run it on the boxes of every image
+        counts = torch.bincount(b, minlength=bs).tolist()
+        i = torch.cat([torchvision.ops.nms(bx, sc, iou_thres) + start for bx, sc, start in
+                       zip(boxes.split(counts), scores.double().split(counts), np.cumsum([0] + counts[:-1]))])
+    i = i[_rank_in_group(b[i], bs) < max_det]  # limit detections
+    if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
+        # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
+        iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
+        weights = iou * scores[None]  # box weights
+        x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
+        if redundant:
+            i = i[iou.sum(1) > 1]  # require redundancy
+
+    counts = torch.bincount(b[i], minlength=bs)
+    return list(x[i].split(counts.tolist()))
+
+
+def _by_image_and_score(b, scores):
+    # Order sorting by image index, then by decreasing score (scores in [0, 1])
+    return (b.double() * 3 - scores.double()).argsort()
+
+
+def _rank_in_group(group, n):
+    # Position of every element inside its group, for a tensor of group indices in [0, n) sorted ascending
+    counts = torch.bincount(group, minlength=n)
+    starts = torch.cumsum(counts, 0) - counts
+    return torch.arange(len(group), device=group.device) - starts[group]
 
 
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,